@@ -1,12 +1,35 @@
 from __future__ import absolute_import
 
+import sys
+import types
+import importlib
+
 from .mimc import MIMCRun, MIMCItrData
-from . import plot
 from .db import MIMCDatabase
 
 
-try:
-    import pkg_resources  # part of setuptools
-    __version__ = pkg_resources.require("mimclib")[0].version
-except:
-    __version__ = "Not installed"
+class _LazyModule(types.ModuleType):
+    # Imports the submodule on first access to one of its attributes
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self.__name__), attr)
+
+# plot imports matplotlib, which is slow, so it is imported on first use
+plot = _LazyModule(__name__ + ".plot")
+
+
+def _get_version():
+    try:
+        import pkg_resources  # part of setuptools
+        return pkg_resources.require("mimclib")[0].version
+    except:
+        return "Not installed"
+
+def __getattr__(name):
+    # Called by Python 3.7 and later, so that the slow pkg_resources is only
+    # imported when the version is needed
+    if name == "__version__":
+        return _get_version()
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+if sys.version_info < (3, 7):
+    __version__ = _get_version()
@@ -0,0 +1,12 @@
+"""
+Synthetic problems with known rates and micro-benchmarks of the core loop
+of MIMCRun and of libset_util. Run
+
+    python -m mimclib.bench -o results.json
+
+to save the timings of all benchmarks, see python -m mimclib.bench -h.
+"""
+from __future__ import absolute_import
+
+from .problems import SyntheticProblem
+from .micro import run_benchmarks, benchmark_names
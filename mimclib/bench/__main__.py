@@ -0,0 +1,47 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import json
+import time
+import platform
+import argparse
+import numpy as np
+
+import mimclib
+from mimclib.bench import run_benchmarks, benchmark_names
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m mimclib.bench",
+                                     description="Run the benchmarks of \
+mimclib and save the results to a JSON file.")
+    parser.add_argument("-o", "--output", type=str,
+                        help="JSON file where the results are saved")
+    parser.add_argument("-k", "--names", nargs="+",
+                        help="Only run the benchmarks whose names contain one \
+of these strings. Available benchmarks: " + ", ".join(benchmark_names()))
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="Number of times every benchmark is run")
+    parser.add_argument("-s", "--scale", type=float, default=1.,
+                        help="Factor of the sizes of the problems")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(names=args.names, repeat=args.repeat,
+                             scale=args.scale)
+    if args.output is not None:
+        data = dict(version=mimclib.__version__,
+                    date=time.strftime("%Y-%m-%d %H:%M:%S"),
+                    python=platform.python_version(),
+                    numpy=np.__version__,
+                    machine=platform.machine(),
+                    repeat=args.repeat, scale=args.scale,
+                    benchmarks=results)
+        with open(args.output, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
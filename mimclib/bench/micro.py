@@ -0,0 +1,311 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import atexit
+import tempfile
+import shutil
+import os.path
+import numpy as np
+
+from .. import setutil
+from .. import mimc
+from .problems import SyntheticProblem
+
+__all__ = []
+
+def public(sym):
+    __all__.append(sym.__name__)
+    return sym
+
+# Name -> function(scale) that returns a function to time, the number of
+# operations it does and optionally a dictionary of other results. The setup
+# is not timed.
+_benchmarks = []
+
+def _benchmark(fn):
+    _benchmarks.append((fn.__name__[len("bench_"):], fn))
+    return fn
+
+
+def _td_set(d, count):
+    lvls = setutil.VarSizeList(min_dim=d)
+    lvls.add_from_list(setutil.GenTDSet(d, count, base=0))
+    return lvls
+
+
+@_benchmark
+def bench_startup(scale):
+    # Starting a process that imports what mimc_run.py scripts need, which
+    # should not include matplotlib
+    import sys
+    import subprocess
+    code = "import sys, mimclib.mimc, mimclib.test; \
+assert 'matplotlib' not in sys.modules, 'matplotlib was imported'"
+    def fn():
+        subprocess.check_call([sys.executable, "-c", code])
+    return fn, 1
+
+@_benchmark
+def bench_run_d1(scale):
+    # The whole MIMC loop on a problem with a cheap sampler
+    def fn():
+        SyntheticProblem(d=1).createRun(0.02/scale, max_TOL=0.5).doRun()
+    return fn, 1
+
+@_benchmark
+def bench_run_d2(scale):
+    def fn():
+        SyntheticProblem(d=2).createRun(0.05/scale, max_TOL=0.5).doRun()
+    return fn, 1
+
+@_benchmark
+def bench_run_d3(scale):
+    def fn():
+        SyntheticProblem(d=3, s=1.5, gamma=0.5).createRun(
+            0.1/scale, max_TOL=0.5).doRun()
+    return fn, 1
+
+@_benchmark
+def bench_sample_sums(scale):
+    # Power sums of a chunk of samples of a level in two dimensions, as
+    # computed after every call to fnSampleLvl
+    M, count = 10000, int(50*scale)
+    mods = mimc.expand_delta([1, 1])[0]
+    values = np.random.rand(M, len(mods))
+    def fn():
+        for k in range(count):
+            mimc.compute_sample_sums(values, mods, 4)
+    return fn, count*M
+
+@_benchmark
+def bench_add_samples(scale):
+    # Accumulating the sums of the samples of the levels one at a time
+    L, count = 100, int(20*scale)
+    itr = mimc.MIMCItrData(min_dim=1, moments=4)
+    itr.lvls_add_from_list(np.arange(L).reshape((-1, 1)))
+    psums = np.random.rand(count, L, 4)
+    def fn():
+        for k in range(count):
+            for i in range(L):
+                itr.addSamples(i, 10, psums[k, i], psums[k, i], 1.)
+    return fn, count*L
+
+@_benchmark
+def bench_add_samples_many(scale):
+    L, count = 100, int(100*scale)
+    itr = mimc.MIMCItrData(min_dim=1, moments=4)
+    itr.lvls_add_from_list(np.arange(L).reshape((-1, 1)))
+    psums = np.random.rand(count, L, 4)
+    def fn():
+        for k in range(count):
+            itr.addSamples_many(np.arange(L), 10*np.ones(L), psums[k],
+                                psums[k], np.ones(L))
+    return fn, count*L
+
+@_benchmark
+def bench_add_samples_central(scale):
+    # Same as add_samples_many, but central sums are kept and merged as
+    # when sampling
+    L, count = 100, int(100*scale)
+    itr = mimc.MIMCItrData(min_dim=1, moments=4)
+    itr.lvls_add_from_list(np.arange(L).reshape((-1, 1)))
+    psums = np.random.rand(count, L, 4)
+    def fn():
+        for k in range(count):
+            itr.addSamples_many(np.arange(L), 10*np.ones(L), psums[k],
+                                psums[k], np.ones(L), psums[k], psums[k])
+    return fn, count*L
+
+@_benchmark
+def bench_lvls_grow(scale):
+    # Adding indices to a VarSizeList one at a time
+    inds = setutil.GenTDSet(3, int(2000*scale), base=0)
+    def fn():
+        lvls = setutil.VarSizeList(min_dim=3)
+        for ind in inds:
+            lvls.add_from_list([ind])
+    return fn, len(inds)
+
+@_benchmark
+def bench_lvls_find(scale):
+    lvls = _td_set(3, int(2000*scale))
+    inds = lvls.to_dense_matrix()
+    def fn():
+        for ind in inds:
+            lvls.find(ind)
+    return fn, len(inds)
+
+def _expand_set(scale, incremental):
+    min_lvls = int(2000*scale)
+    profCalc = setutil.TDProfCalculator(np.ones(3))
+    count = [0]
+    def fn():
+        lvls = setutil.VarSizeList(min_dim=3)
+        mimc.extend_prof_lvls(lvls, profCalc, min_lvls, incremental)
+        count[0] = len(lvls)
+    fn()
+    return fn, count[0]
+
+@_benchmark
+def bench_lvls_csr(scale):
+    # Exporting all indices of a set at once and building a set from them
+    lvls = _td_set(4, int(20000*scale))
+    def fn():
+        setutil.VarSizeList.from_csr(*lvls.to_csr(), min_dim=4)
+    return fn, len(lvls)
+
+@_benchmark
+def bench_expand_set(scale):
+    # Adding the index of maximum profit, as extend_prof_lvls does
+    return _expand_set(scale, incremental=False)
+
+@_benchmark
+def bench_expand_set_incremental(scale):
+    return _expand_set(scale, incremental=True)
+
+@_benchmark
+def bench_get_index_set(scale):
+    # Building a whole index set up to a given profit
+    max_prof = int(25*scale**(1/3.))
+    profCalc = setutil.TDProfCalculator(np.ones(3))
+    count = [0]
+    def fn():
+        lvls = setutil.VarSizeList(min_dim=3)
+        lvls.add_from_list([[]])
+        lvls.expand_set(profCalc, max_prof=max_prof)
+        count[0] = len(lvls)
+    fn()
+    return fn, count[0]
+
+@_benchmark
+def bench_estimate_bias(scale):
+    lvls = _td_set(3, int(5000*scale))
+    err = np.exp(-np.sum(lvls.to_dense_matrix(), axis=1).astype(float))
+    repeat = 10
+    def fn():
+        for i in range(repeat):
+            lvls.estimate_bias(err)
+    return fn, repeat*len(lvls)
+
+def _rss():
+    # Resident memory of the process in bytes, or None if it is not known
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return None
+
+@_benchmark
+def bench_lvls_large(scale):
+    # Finding the outer profit of a large set and expanding it, and the memory
+    # that the set takes
+    d, max_prof = 5, int(25*scale**(1/5.))
+    profCalc = setutil.TDProfCalculator(np.ones(d))
+    rss = _rss()
+    lvls = setutil.VarSizeList(min_dim=d)
+    lvls.add_from_list([[]])
+    lvls.expand_set(profCalc, max_prof=max_prof)
+    count = len(lvls)
+    extra = dict(count=count)
+    if rss is not None:
+        extra["bytes_per_index"] = (_rss() - rss) / count
+    def fn():
+        tStart = time.time()
+        lvls.get_min_outer_prof(profCalc)
+        extra["min_outer_prof"] = time.time() - tStart
+        new_lvls = lvls.sublist(np.arange(count))
+        tStart = time.time()
+        new_lvls.expand_set(profCalc)
+        extra["expand_set"] = time.time() - tStart
+    return fn, count, extra
+
+def _runs(scale, count=4):
+    runs = []
+    for seed in range(count):
+        run = SyntheticProblem(d=2).createRun(0.05/scale, max_TOL=0.5,
+                                              seed=seed)
+        run.doRun()
+        runs.append(run)
+    return runs
+
+@_benchmark
+def bench_db(scale):
+    # Writing all iterations of some runs to an sqlite database and reading
+    # them back
+    from .. import db as mimcdb
+    runs = _runs(scale)
+    path = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, path, True)
+    def fn():
+        db = mimcdb.MIMCDatabase(engine="sqlite",
+                                 db=os.path.join(path, "bench.sqlite"))
+        ids = []
+        for run in runs:
+            run_id = db.createRun(mimc_run=run, tag="bench")
+            for i in range(len(run.iters)):
+                db.writeRunData(run_id, run, iteration_idx=i)
+            db.markRunSuccessful(run_id)
+            ids.append(run_id)
+        db.readRunsByID(ids)
+        db.deleteRuns(ids)
+    fn()    # Fails early if the dependencies of the database are missing
+    return fn, np.sum([len(run.iters) for run in runs])
+
+@_benchmark
+def bench_plot_stats(scale):
+    # Statistics that are computed for the plots, without plotting
+    from .. import plot
+    runs = _runs(scale)
+    calc_moments = getattr(plot, "__calc_moments")
+    def fn():
+        plot.computeIterationStats(runs, work_bins=50, xi='work',
+                                   filteritr=plot.filteritr_all,
+                                   fnNorm=np.abs, exact=1.)
+        calc_moments(runs, seed=np.zeros(2, dtype=np.uint32),
+                     direction=np.array([1, 0]), fnNorm=np.abs)
+    return fn, np.sum([len(run.iters) for run in runs])
+
+
+@public
+def benchmark_names():
+    return [name for name, _ in _benchmarks]
+
+@public
+def run_benchmarks(names=None, repeat=3, scale=1., verbose=True):
+    """
+    Runs the benchmarks whose names contain one of the strings names, or all
+    of them if names is None. scale multiplies the sizes of the problems.
+    Returns a dictionary with the best and mean time of every benchmark over
+    repeat runs, its number of operations per second and the other results
+    that it reports, for example memory usage. Benchmarks that fail, for
+    example because a dependency is missing, have the key error instead.
+    """
+    results = dict()
+    for name, bench in _benchmarks:
+        if names is not None and not any(n in name for n in names):
+            continue
+        np.random.seed(0)
+        try:
+            ret = bench(scale)
+            fn, ops = ret[:2]
+            times = []
+            for i in range(repeat):
+                tStart = time.time()
+                fn()
+                times.append(time.time() - tStart)
+        except Exception as e:
+            results[name] = dict(error="{}: {}".format(type(e).__name__, e))
+            if verbose:
+                print("{:<24} failed: {}".format(name, results[name]["error"]))
+            continue
+        results[name] = dict(best=np.min(times), mean=np.mean(times),
+                             repeat=repeat, ops=int(ops),
+                             ops_per_sec=ops / np.min(times))
+        if len(ret) > 2:
+            results[name].update(ret[2])
+        if verbose:
+            print("{:<24}{:>12.4f} sec.{:>15.1f} ops/sec".format(
+                name, results[name]["best"], results[name]["ops_per_sec"]))
+    return results
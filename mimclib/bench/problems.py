@@ -0,0 +1,83 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import numpy as np
+
+__all__ = []
+
+def public(sym):
+    __all__.append(sym.__name__)
+    return sym
+
+
+@public
+class SyntheticProblem(object):
+    """
+    A problem with d dimensions of discretization whose approximation at the
+    multi-index l is
+
+        G_l = prod_i (1 + beta^(-w_i l_i) + Z_i beta^(-s_i l_i/2))
+
+    where Z_i are independent standard normal random variables. The exact
+    value E[G] is 1 and the mixed differences of G_l satisfy
+
+        |E[Delta G_l]| ~ beta^(-w.l), Var[Delta G_l] ~ beta^(-s.l)
+
+    when s <= 2*w. The work per sample is modeled as beta^(gamma.l), see
+    workModel, while the actual cost of sampleLvl is small.
+    """
+    exact = 1.
+
+    def __init__(self, d=1, w=1., s=2., gamma=1., beta=2.):
+        self.d = d
+        self.w = np.ones(d) * w
+        self.s = np.ones(d) * s
+        self.gamma = np.ones(d) * gamma
+        self.beta = np.ones(d) * beta
+
+    def params(self):
+        """
+        Returns the parameters of MIMCRun that describe the problem
+        """
+        return dict(min_dim=self.d, w=self.w, s=self.s, gamma=self.gamma,
+                    beta=self.beta, h0inv=np.ones(self.d))
+
+    def sampleLvl(self, inds, M):
+        """
+        fnSampleLvl of the problem
+        """
+        tStart = time.time()
+        inds = np.array(inds, dtype=np.float).reshape((len(inds), -1))
+        Z = np.random.normal(size=(M, 1, self.d))
+        l = inds[None, :, :self.d]
+        g = 1 + self.beta**(-self.w*l) + Z*self.beta**(-self.s*l/2.)
+        return np.prod(g, axis=2), time.time() - tStart
+
+    def workModel(self, lvls):
+        """
+        fnWorkModel of the problem
+        """
+        return np.prod(self.beta**(lvls.to_dense_matrix(d_end=self.d) *
+                                   self.gamma), axis=1)
+
+    def createRun(self, TOL, seed=0, M0=10, **kwargs):
+        """
+        Returns a MIMCRun for the problem with the default options of
+        MIMCRun.addOptionsToParser, except for TOL, seed, M0 and kwargs.
+        """
+        import argparse
+        from .. import mimc
+        parser = argparse.ArgumentParser()
+        mimc.MIMCRun.addOptionsToParser(parser)
+        params = vars(parser.parse_args([]))
+        params = dict((k, v) for k, v in params.items() if v is not None)
+        params.update(self.params())
+        params.update(TOL=TOL, seed=seed, M0=np.array([M0]))
+        params.update(kwargs)
+        run = mimc.MIMCRun(**params)
+        run.setFunctions(fnSampleLvl=self.sampleLvl,
+                         fnWorkModel=self.workModel,
+                         fnItrDone=None)
+        return run
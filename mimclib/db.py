@@ -290,6 +290,8 @@ class MIMCDatabase(object):
         tT = iteration.tT
         Wl = iteration.Wl_estimate
         Ml = iteration.M
+        psums_delta = iteration.psums_delta
+        psums_fine = iteration.psums_fine
 
         prev_iter = mimc_run.iters[iteration_idx-1] if iteration_idx >= 1 else None
         if prev_iter is not None:
@@ -297,6 +299,9 @@ class MIMCDatabase(object):
             prev_tT = iteration.tT
             prev_Wl = iteration.Wl_estimate
             prev_Ml = iteration.M
+            # Reading the sums of a previous iteration makes a copy
+            prev_psums_delta = prev_iter.psums_delta
+            prev_psums_fine = prev_iter.psums_fine
 
         with self.DBConn(**self.connArgs) as cur:
             cur.execute('''
@@ -311,25 +316,26 @@ VALUES(datetime(), ?, ?, ?, ?, ?, ?, ?, ?)''',
 
             # Only add levels that are different from the
             #       previous iteration
+            lvls = list(iteration.lvls_sparse_itr())
             for k in range(0, iteration.lvls_count):
                 lvl_data = _nan2none([El[k], Vl[k], Wl[k], tT[k], Ml[k]])
                 if prev_iter is not None:
                     if k < prev_iter.lvls_count:
-                        if np.all(prev_iter.psums_delta[k, :] == iteration.psums_delta[k, :]) and \
-                           np.all(prev_iter.psums_fine[k, :] == iteration.psums_fine[k, :]) and \
+                        if np.all(prev_psums_delta[k, :] == psums_delta[k, :]) and \
+                           np.all(prev_psums_fine[k, :] == psums_fine[k, :]) and \
                            np.all(np.array(lvl_data[1:]) ==
                                   _nan2none([prev_Vl[k],
                                              prev_Wl[k], prev_tT[k], prev_Ml[k]])):
                             continue         # Index is repeated as is in this iteration
 
                 lvl = ",".join(["%d|%d" % (i, j) for i, j in
-                                enumerate(iteration.lvls_get(k)) if j > base])
+                                zip(*lvls[k]) if j > base])
                 cur.execute('''
 INSERT INTO tbl_lvls(lvl, lvl_hash, psums_delta, psums_fine, iter_id,  El, Vl, Wl, tT, Ml)
 VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
                             [lvl, _md5(lvl),
-                             _pickle(iteration.psums_delta[k, :]),
-                             _pickle(iteration.psums_fine[k, :]), iter_id]+
+                             _pickle(psums_delta[k, :]),
+                             _pickle(psums_fine[k, :]), iter_id]+
                             lvl_data)
 
     def readRunsByID(self, run_ids):
@@ -400,20 +406,26 @@ ORDER BY dr.run_id, dr.iteration_idx
                 iteration.bias = _none2nan(data[5])
                 iteration.stat_error = _none2nan(data[6])
                 iteration.Q = _unpickle(data[7])
-                for l in dictLvls[iter_id]:
+                lvls = dictLvls.get(iter_id, [])
+                ks = np.empty(len(lvls), dtype=np.int)
+                for i, l in enumerate(lvls):
                     t = np.array(map(int, [p for p in re.split(",|\|", l[1]) if p]),
                                  dtype=setutil.ind_t)
                     k = iteration.lvls_find(ind=t[1::2], j=t[::2])
                     if k is None:
                         iteration.lvls_add_from_list(inds=[t[1::2]], j=[t[::2]])
                         k = iteration.lvls_count-1
-                    iteration.zero_samples(k)
-                    iteration.addSamples(k, M=_none2nan(l[4]),
-                                         tT=_none2nan(l[5]),
-                                         psums_delta=_unpickle(l[2]),
-                                         psums_fine=_unpickle(l[3]))
-                    iteration.Wl_estimate[k] = _none2nan(l[6])
-                    iteration.Vl_estimate[k] = _none2nan(l[7])
+                    ks[i] = k
+                if len(lvls) > 0:
+                    # All levels are added at once, see addSamples_many
+                    iteration.zero_samples(ks)
+                    iteration.addSamples_many(
+                        ks, M=[_none2nan(l[4]) for l in lvls],
+                        tT=[_none2nan(l[5]) for l in lvls],
+                        psums_delta=np.array([_unpickle(l[2]) for l in lvls]),
+                        psums_fine=np.array([_unpickle(l[3]) for l in lvls]))
+                    iteration.Wl_estimate[ks] = [_none2nan(l[6]) for l in lvls]
+                    iteration.Vl_estimate[ks] = [_none2nan(l[7]) for l in lvls]
                 run.iters.append(iteration)
         return lstruns
 
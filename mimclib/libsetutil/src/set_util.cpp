@@ -256,6 +256,15 @@ double GetMinOuterProfit(const PVarSizeList pset,
     return pset->get_min_outer_profit(profCalc);
 }
 
+void ExpandIndexSet(PVarSizeList pset,
+                    const PProfitCalculator profCalc,
+                    double max_prof){
+    if (!pset->has_ind(mul_ind_t()))
+        GetIndexSet(pset, profCalc, max_prof, 0);  // Has no outer indices
+    else
+        pset->expand_to_profit(profCalc, max_prof);
+}
+
 void CalculateSetProfit(const PVarSizeList pset,
                         const PProfitCalculator profCalc,
                         double *log_prof, uint32 size){
@@ -347,6 +356,12 @@ void VarSizeList_to_matrix(const PVarSizeList pset, ind_t *ij, uint32 ij_size,
     pset->to_matrix(ij, ij_size, data, data_size);
 }
 
+void VarSizeList_to_csr(const PVarSizeList pset, uint32 start, uint32 end,
+                        uint32 *indptr, uint32 indptr_size,
+                        ind_t *indices, ind_t *data, uint32 nnz){
+    pset->to_csr(start, end, indptr, indptr_size, indices, data, nnz);
+}
+
 PProfitCalculator CreateMISCProfCalc(ind_t d, ind_t s, const double *d_w,
                                      const double *s_err_w){
     return new MISCProfCalculator(d, s, d_w, s_err_w);
@@ -387,6 +402,21 @@ PVarSizeList VarSizeList_from_matrix(PVarSizeList pset,
     return pset;
 }
 
+PVarSizeList VarSizeList_from_csr(PVarSizeList pset,
+                                  const uint32 *indptr, uint32 count,
+                                  const ind_t *indices, const ind_t *data,
+                                  uint32 nnz){
+    // Row i has the entries indptr[i] to indptr[i+1] of indices and data
+    if (!pset)
+        pset = new VarSizeList(count);
+    for (uint32 i=0;i<count;i++){
+        assert(indptr[i] <= indptr[i+1] && indptr[i+1] <= nnz);
+        pset->push_back(mul_ind_t(indices+indptr[i], data+indptr[i],
+                                  indptr[i+1]-indptr[i]));
+    }
+    return pset;
+}
+
 int VarSizeList_find(const PVarSizeList pset, ind_t *j, ind_t *data,
                      ind_t size){
     uint32 index;
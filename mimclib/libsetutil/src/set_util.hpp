@@ -54,6 +54,9 @@ extern "C"{
                              const PProfitCalculator profCalc,
                              double max_prof,
                              double **p_profits);
+    void ExpandIndexSet(PVarSizeList,
+                        const PProfitCalculator profCalc,
+                        double max_prof);
 
     void GetAdaptiveOrder(const PVarSizeList,
                           double *log_profits,
@@ -82,12 +85,19 @@ extern "C"{
     void VarSizeList_to_matrix(const PVarSizeList,
                                ind_t *ij, uint32 ij_size,
                                ind_t *data, uint32 data_size);
+    void VarSizeList_to_csr(const PVarSizeList, uint32 start, uint32 end,
+                            uint32 *indptr, uint32 indptr_size,
+                            ind_t *indices, ind_t *data, uint32 nnz);
     int VarSizeList_find(const PVarSizeList, ind_t *j, ind_t *data,
                          ind_t size);
     PVarSizeList VarSizeList_from_matrix(PVarSizeList,
                                          const ind_t *sizes, uint32 sizes_size,
                                          const ind_t *j, uint32 j_size,
                                          const ind_t *data, uint32 data_size);
+    PVarSizeList VarSizeList_from_csr(PVarSizeList,
+                                      const uint32 *indptr, uint32 count,
+                                      const ind_t *indices, const ind_t *data,
+                                      uint32 nnz);
 
     void FreeProfitCalculator(PProfitCalculator profCalc);
     void FreeIndexSet(PVarSizeList);
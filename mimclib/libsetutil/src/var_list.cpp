@@ -81,36 +81,121 @@ void VarSizeList::make_profits_admissible(ind_t d_start,
 }
 
 
+// Returns the outer profits of profCalc, with the neighbours of all indices
+VarSizeList::OuterProfits& VarSizeList::outer_profits(const PProfitCalculator profCalc) const {
+    typedef OuterProfits::Entry Entry;
+    auto outer = std::find_if(m_outer.begin(), m_outer.end(),
+                              [profCalc](const OuterProfits& o)
+                              { return o.prof_calc_id == profCalc->id(); });
+    if (outer == m_outer.end()){
+        // Forget the calculator that was used first
+        if (m_outer.size() >= MAX_OUTER_PROFITS)
+            m_outer.erase(m_outer.begin());
+        OuterProfits o;
+        o.prof_calc_id = profCalc->id();
+        o.processed = 0;
+        o.compact_size = 0;
+        m_outer.push_back(o);
+        outer = m_outer.end()-1;
+    }
+
+    ind_t max_d = profCalc->max_dim();
+    std::vector<Entry> &heap = outer->heap;
+    for (;outer->processed<this->count();outer->processed++){
+        uint32 k = outer->processed;
+        if (m_neighbors[k] >= max_d)
+            continue;  // All neighbours are in the set
+        auto cur = this->get(k);
+        for (ind_t i=0;i<max_d;i++){
+            cur.step(i, 1);
+            if (!this->has_ind(cur)){
+                Entry e = {profCalc->calc_log_prof(cur), k, i};
+                heap.push_back(e);
+                std::push_heap(heap.begin(), heap.end());
+            }
+            cur.step(i, -1);
+        }
+    }
+
+    if (heap.size() > 2*outer->compact_size + 64){
+        // Remove all neighbours that were added to the set
+        heap.erase(std::remove_if(heap.begin(), heap.end(),
+                                  [this](const Entry &e)
+                                  { return this->has_ind(outer_ind(e)); }),
+                   heap.end());
+        std::make_heap(heap.begin(), heap.end());
+        outer->compact_size = heap.size();
+    }
+    return *outer;
+}
+
 // Returns the minimum profit on the outer set
 double VarSizeList::get_min_outer_profit(const PProfitCalculator profCalc) const {
-    ind_t max_d = profCalc->max_dim();//set.max_dim();
-    std::vector<ind_t> bnd_neigh = this->count_neighbors();
+    std::vector<OuterProfits::Entry> &heap = outer_profits(profCalc).heap;
+    while (!heap.empty() && this->has_ind(outer_ind(heap.front()))){
+        std::pop_heap(heap.begin(), heap.end());
+        heap.pop_back();
+    }
+    if (heap.empty())
+        return std::numeric_limits<double>::infinity();
+    return heap.front().profit;
+}
 
-    //------------- Calculate outer boundary
-    double minProf = std::numeric_limits<double>::infinity();
-    unsigned int bnd_count = 0;
-    for (uint32 k=0;k<this->count();k++){
-        if (bnd_neigh[k] < max_d) {
-            // This is a boundary, check all outer indices that are
-            // not in the set already
-            auto cur = this->get(k);
-            //std::cout << k << " / " << cur << " / " << profCalc->calc_log_prof(cur) << std::endl;
-            double profit_cur = profCalc->calc_log_prof(cur);
-            if (minProf < profit_cur)
-                continue;  // No need to check further, profits only increase
-            //cur.resize(max_d, SET_BASE);
-            for (uint32 i=0;i<max_d;i++){
-                cur.step(i, 1);
-                if (!this->has_ind(cur) && minProf > profit_cur) {
-                    double curProf = profCalc->calc_log_prof(cur);
-                    minProf = std::min(minProf, curProf);
-                    bnd_count++;
+// Adds all indices with profit <= max_prof that are not in the set, like
+// GetIndexSet, but starts from the outer indices of the set instead of the
+// zero index. Assumes that the set is downward closed and that profits do
+// not decrease when an index is increased.
+void VarSizeList::expand_to_profit(const PProfitCalculator profCalc,
+                                   double max_prof) {
+    struct New {
+        mul_ind_t ind;
+        double profit;
+    };
+    std::vector<New> added;
+    VarSizeList added_set;
+    std::vector<OuterProfits::Entry> &heap = outer_profits(profCalc).heap;
+    while (!heap.empty() && heap.front().profit <= max_prof){
+        mul_ind_t cur = outer_ind(heap.front());
+        if (!this->has_ind(cur) && !added_set.has_ind(cur)){
+            New n = {cur, heap.front().profit};
+            added.push_back(n);
+            added_set.push_back(cur);
+        }
+        std::pop_heap(heap.begin(), heap.end());
+        heap.pop_back();
+    }
+
+    // The remaining indices are neighbours of the added ones
+    ind_t max_d = profCalc->max_dim();
+    for (size_t k=0;k<added.size();k++){
+        mul_ind_t cur = added[k].ind;
+        for (ind_t i=0;i<max_d;i++){
+            cur.step(i, 1);
+            if (!this->has_ind(cur) && !added_set.has_ind(cur)){
+                double profit = profCalc->calc_log_prof(cur);
+                if (profit <= max_prof){
+                    New n = {cur, profit};
+                    added.push_back(n);
+                    added_set.push_back(cur);
                 }
-                cur.step(i, -1);
             }
+            cur.step(i, -1);
         }
     }
-    return minProf;
+
+    // The order in which GetIndexSet adds indices of equal profit
+    std::sort(added.begin(), added.end(), [](const New &a, const New &b) {
+            if (a.profit != b.profit)
+                return a.profit < b.profit;
+            if (a.ind.size() != b.ind.size())
+                return a.ind.size() < b.ind.size();
+            for (ind_t j=0;j<a.ind.size();j++)
+                if (a.ind[j] != b.ind[j])
+                    return a.ind[j] < b.ind[j];
+            return false;
+        });
+    for (auto itr=added.begin();itr!=added.end();itr++)
+        this->push_back(itr->ind);
 }
 
 void VarSizeList::calc_set_profit(const PProfitCalculator profCalc,
@@ -189,21 +274,8 @@ void VarSizeList::get_level_boundaries(const uint32 *levels,
 
 void VarSizeList::count_neighbors(ind_t* bnd_neigh, size_t size) const {
     assert(size >= this->count());
-    for (uint32 k=0;k<this->count();k++) bnd_neigh[k]=0;
-
-    for (uint32 k=0;k<this->count();k++){
-        // Update Neighbors
-        auto cur = this->get(k);
-        for (unsigned int j=0;j<cur.size();j++){
-            if (cur[j] == SET_BASE) continue;
-            cur.step(j, -1);
-            uint32 index;
-            if (this->find_ind(cur, index))
-                bnd_neigh[index]++;
-            cur.step(j, 1);
-            DEBUG_ASSERT(cur.size() == this->get(k).size());
-        }
-    }
+    // Updated by push_back
+    std::copy(m_neighbors.begin(), m_neighbors.end(), bnd_neigh);
 }
 
 uint32 add_children(const VarSizeList* pthis, uint32 k, VarSizeList &result,
@@ -418,7 +490,7 @@ double VarSizeList::estimate_bias(const double *err_contributions,
                                   uint32 count,
                                   const double *rates, uint32 rates_size) const {
     ind_t max_d = this->max_dim();
-    assert(count >= this->count && rates_size >= max_d);
+    assert(count >= this->count() && rates_size >= max_d);
     std::vector<ind_t> bnd_neigh = this->count_neighbors();
 
     std::map<mul_ind_t, double> map_contrib;
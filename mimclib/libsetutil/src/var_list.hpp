@@ -8,8 +8,8 @@ typedef unsigned short ind_t;
 #include <stdexcept>
 #include <vector>
 #include <map>
-#include <list>
 #include <algorithm>
+#include <cstdint>
 
 class Node {
 public:
@@ -87,30 +87,62 @@ public:
         ind_t ind;
         ind_t value;
     };
-    typedef std::list<Index>::const_iterator const_iterator;
-    typedef std::list<Index>::iterator iterator;
+    typedef const Index* const_iterator;
+    typedef Index* iterator;
 
-SparseMIndex() : m_max_size(0){ }
+    // The non-zero entries are stored contiguously, sorted by ind. Up to
+    // INLINE_SIZE entries are stored in the object itself, more are stored
+    // in an array on the heap.
+    static const ind_t INLINE_SIZE = 4;
+
+SparseMIndex() : m_active(0), m_capacity(INLINE_SIZE), m_max_size(0){ }
 SparseMIndex(const SparseMIndex& rhs) :
-    m_indices(rhs.m_indices), m_max_size(rhs.m_max_size){ }
-SparseMIndex(const ind_t *ind, ind_t d) : m_max_size(0){
+    m_active(0), m_capacity(INLINE_SIZE), m_max_size(0){
+        assign(rhs);
+    }
+SparseMIndex(SparseMIndex&& rhs) :
+    m_active(0), m_capacity(INLINE_SIZE), m_max_size(0){
+        swap(rhs);
+    }
+SparseMIndex(const ind_t *ind, ind_t d) : m_active(0), m_capacity(INLINE_SIZE),
+        m_max_size(0){
+        reserve(count_nonzero(ind, d));
         for (ind_t i=0;i<d;i++)
             if (ind[i] != SET_BASE){
                 assert(ind[i] > SET_BASE);
-                m_indices.push_back(Index(i, ind[i]));
-                m_max_size = std::max(m_max_size, i+1);
+                data()[m_active++] = Index(i, ind[i]);
+                m_max_size = std::max<ind_t>(m_max_size, i+1);
             }
     }
 
-SparseMIndex(const ind_t *j, const ind_t *ind, ind_t d) : m_max_size(0){
+SparseMIndex(const ind_t *j, const ind_t *ind, ind_t d) : m_active(0),
+        m_capacity(INLINE_SIZE), m_max_size(0){
+        reserve(count_nonzero(ind, d));
         for (ind_t i=0;i<d;i++)
             if (ind[i] != SET_BASE){
                 assert(ind[i] > SET_BASE);
-                m_indices.push_back(Index(j[i], ind[i]));
-                m_max_size = std::max(m_max_size, j[i]+1);
+                assert(m_active == 0 || j[i] > data()[m_active-1].ind);
+                data()[m_active++] = Index(j[i], ind[i]);
+                m_max_size = std::max<ind_t>(m_max_size, j[i]+1);
             }
     }
 
+    ~SparseMIndex(){
+        if (on_heap())
+            delete[] m_storage.heap;
+    }
+
+    SparseMIndex& operator=(const SparseMIndex& rhs){
+        if (this != &rhs)
+            assign(rhs);
+        return *this;
+    }
+
+    SparseMIndex& operator=(SparseMIndex&& rhs){
+        swap(rhs);
+        return *this;
+    }
+
     inline ind_t get(ind_t i) const {
         const_iterator itr;
         if (!get_itr(i, itr)) return SET_BASE;
@@ -126,14 +158,14 @@ SparseMIndex(const ind_t *j, const ind_t *ind, ind_t d) : m_max_size(0){
         assert(value >= SET_BASE);
         if (!found){
             if (value > SET_BASE) {
-                itr = m_indices.insert(itr, Index(i, value));
-                m_max_size = std::max(m_max_size, i+1);
+                insert(itr, Index(i, value));
+                m_max_size = std::max<ind_t>(m_max_size, i+1);
             } // Otherwise, just ignore the whole thing
         }
         else if (value > SET_BASE)
             itr->value = value;
         else {
-            m_indices.erase(itr);
+            erase(itr);
             update_size();
         }
     }
@@ -143,8 +175,8 @@ SparseMIndex(const ind_t *j, const ind_t *ind, ind_t d) : m_max_size(0){
         bool found = get_itr(i, itr);
         if (!found){
             assert(step >= 0);
-            itr = m_indices.insert(itr, Index(i, SET_BASE+step));
-            m_max_size = std::max(m_max_size, i+1);
+            insert(itr, Index(i, SET_BASE+step));
+            m_max_size = std::max<ind_t>(m_max_size, i+1);
         }
         else
         {
@@ -154,7 +186,7 @@ SparseMIndex(const ind_t *j, const ind_t *ind, ind_t d) : m_max_size(0){
             }
             else
             {
-                itr = m_indices.erase(itr);
+                erase(itr);
                 update_size();
             }
         }
@@ -165,11 +197,11 @@ SparseMIndex(const ind_t *j, const ind_t *ind, ind_t d) : m_max_size(0){
     }
 
     ind_t active() const {
-        return m_indices.size();
+        return m_active;
     }
 
-    const_iterator begin() const { return m_indices.begin(); }
-    const_iterator end() const { return m_indices.end(); }
+    const_iterator begin() const { return data(); }
+    const_iterator end() const { return data() + m_active; }
 
     std::vector<ind_t> dense(ind_t dim) const{
         std::vector<ind_t> ret(dim, SET_BASE);
@@ -194,14 +226,6 @@ SparseMIndex(const ind_t *j, const ind_t *ind, ind_t d) : m_max_size(0){
             // The indices are different, the one with the least
             // index is active
             return itr_a->ind > itr_b->ind;
-            // if (itr_a->index < itr_b->index){
-            //     // Means that b[itr_a->index] = SET_BASE
-            //     return false;
-            // }
-            // if (itr_a->index > itr_b->index){
-            //     // Means that a[itr_b->index] = SET_BASE
-            //     return true;
-            // }
         }
 
         if (itr_a == a.end() && itr_b == b.end())
@@ -209,51 +233,117 @@ SparseMIndex(const ind_t *j, const ind_t *ind, ind_t d) : m_max_size(0){
         return itr_a == a.end();
     }
 
+    bool operator==(const SparseMIndex& b) const {
+        return m_active == b.m_active && std::equal(begin(), end(), b.begin(),
+            [](const Index &x, const Index &y)
+            { return x.ind == y.ind && x.value == y.value; });
+    }
+
+    // Equal indices have equal hashes, since only the non-zero entries are
+    // stored
+    uint64_t hash() const {
+        uint64_t h = m_active;
+        for (auto itr=begin();itr!=end();itr++)
+            h ^= ((uint64_t(itr->ind) << 16) | itr->value) +
+                0x9e3779b97f4a7c15ULL + (h << 6) + (h >> 2);
+        // The low bits select the slot in VarSizeList, so mix all bits in
+        h ^= h >> 33;
+        h *= 0xff51afd7ed558ccdULL;
+        h ^= h >> 33;
+        return h;
+    }
+
 private:
-    iterator begin() { return m_indices.begin(); }
-    iterator end() { return m_indices.end(); }
+    bool on_heap() const { return m_capacity > INLINE_SIZE; }
+    Index* data() { return on_heap() ? m_storage.heap : m_storage.local; }
+    const Index* data() const { return on_heap() ? m_storage.heap : m_storage.local; }
+    iterator begin() { return data(); }
+    iterator end() { return data() + m_active; }
+
+    static ind_t count_nonzero(const ind_t *ind, ind_t d){
+        ind_t nnz = 0;
+        for (ind_t i=0;i<d;i++)
+            nnz += ind[i] != SET_BASE;
+        return nnz;
+    }
+
+    void reserve(ind_t capacity){
+        if (capacity <= m_capacity)
+            return;
+        Index *heap = new Index[capacity];
+        std::copy(begin(), end(), heap);
+        if (on_heap())
+            delete[] m_storage.heap;
+        m_storage.heap = heap;
+        m_capacity = capacity;
+    }
+
+    void assign(const SparseMIndex& rhs){
+        m_active = 0;
+        reserve(rhs.m_active);
+        std::copy(rhs.begin(), rhs.end(), data());
+        m_active = rhs.m_active;
+        m_max_size = rhs.m_max_size;
+    }
+
+    void swap(SparseMIndex& rhs){
+        std::swap(m_storage, rhs.m_storage);
+        std::swap(m_active, rhs.m_active);
+        std::swap(m_capacity, rhs.m_capacity);
+        std::swap(m_max_size, rhs.m_max_size);
+    }
+
+    iterator insert(iterator pos, const Index& value){
+        size_t k = pos - begin();
+        if (m_active == m_capacity)
+            reserve(2*m_capacity);
+        pos = begin() + k;
+        std::copy_backward(pos, end(), end()+1);
+        *pos = value;
+        m_active++;
+        return pos;
+    }
+
+    iterator erase(iterator pos){
+        std::copy(pos+1, end(), pos);
+        m_active--;
+        return pos;
+    }
+
     bool get_itr(ind_t i, iterator &ind_after) {
-        for (auto itr=begin();itr!=end();itr++){
-            if (itr->ind == i){
-                ind_after = itr;
-                return true;
-            }
-            else if (itr->ind > i) { // The indices are sorted
-                ind_after = itr;
-                return false;
-            }
-        }
-        ind_after = end();
-        return false;
+        // The indices are sorted
+        ind_after = std::lower_bound(begin(), end(), i,
+                                     [](const Index &x, ind_t v)
+                                     { return x.ind < v; });
+        return ind_after != end() && ind_after->ind == i;
     }
     bool get_itr(ind_t i, const_iterator &ind_after) const {
-        for (auto itr=begin();itr!=end();itr++){
-            if (itr->ind == i){
-                ind_after = itr;
-                return true;
-            }
-            else if (itr->ind > i) { // The indices are sorted
-                ind_after = itr;
-                return false;
-            }
-        }
-        ind_after = end();
-        return false;
+        ind_after = std::lower_bound(begin(), end(), i,
+                                     [](const Index &x, ind_t v)
+                                     { return x.ind < v; });
+        return ind_after != end() && ind_after->ind == i;
     }
     void update_size(){
-        m_max_size=0;
-        for (auto itr=begin();itr!=end();itr++)
-            m_max_size = std::max(m_max_size, itr->ind+1);
+        m_max_size = m_active > 0 ? data()[m_active-1].ind+1 : 0;
     }
 
-    std::list<Index> m_indices;
-    int m_max_size;
+    union Storage {
+        Storage() : heap(0) {}
+        Index *heap;
+        Index local[INLINE_SIZE];
+    } m_storage;
+    ind_t m_active;
+    ind_t m_capacity;
+    ind_t m_max_size;
 };
 typedef SparseMIndex mul_ind_t;
 
 class ProfitCalculator {
 public:
+    ProfitCalculator() : m_id(next_id()) {}
     virtual ~ProfitCalculator(){}
+    // Unique among all calculators, unlike the address which can be reused
+    uint64_t id() const { return m_id; }
     virtual double calc_log_prof(const mul_ind_t &ind)=0;
     virtual ind_t max_dim()=0;
 
@@ -261,6 +351,12 @@ public:
         if (ind.size() > max_dim())
             throw std::runtime_error("Index too large for profit calculator");
     }
+private:
+    static uint64_t next_id(){
+        static uint64_t id = 0;
+        return ++id;
+    }
+    uint64_t m_id;
 };
 
 typedef ProfitCalculator* PProfitCalculator;
@@ -277,7 +373,10 @@ public:
             push_back(set.m_ind_set[idx[i]]);
         }
     }
- VarSizeList(const VarSizeList &set) : m_ind_set(set.m_ind_set) , m_ind_map(set.m_ind_map), m_max_dim(set.m_max_dim)
+ VarSizeList(const VarSizeList &set) : m_ind_set(set.m_ind_set),
+        m_ind_hash(set.m_ind_hash), m_hash_slots(set.m_hash_slots),
+        m_neighbors(set.m_neighbors), m_outer(set.m_outer),
+        m_max_dim(set.m_max_dim)
     { }
 
     ind_t max_dim() const {
@@ -298,11 +397,7 @@ public:
     }
 
     bool find_ind(const mul_ind_t& cur, uint32 &index) const{
-        auto itr = m_ind_map.find(cur);
-        if (itr == m_ind_map.end())
-            return false;
-        index = itr->second;
-        return true;
+        return find_hashed(cur, cur.hash(), index);
     }
 
     uint32 find_ind(const mul_ind_t& cur) const {
@@ -358,12 +453,53 @@ public:
         }
     }
 
+    // Writes the indices start to end-1 in the compressed sparse row format,
+    // the entries of index start+i are indptr[i] to indptr[i+1]-1 of indices
+    // and data
+    void to_csr(uint32 start, uint32 end,
+                uint32 *indptr, uint32 indptr_size,
+                ind_t *indices, ind_t *data, uint32 nnz) const {
+        assert(start <= end && end <= count() && indptr_size > end-start);
+        uint32 id=0;
+        indptr[0] = 0;
+        for (uint32 row=start;row<end;row++){
+            const mul_ind_t &cur = m_ind_set[row];
+            assert(id+cur.active() <= nnz);
+            for (auto ind_itr=cur.begin();ind_itr!=cur.end();ind_itr++){
+                indices[id] = ind_itr->ind;
+                data[id++] = ind_itr->value;
+            }
+            indptr[row-start+1] = id;
+        }
+    }
+
     void push_back(const mul_ind_t& ind){
         // WARNING: Does not check uniqueness
-        if (this->has_ind(ind))
+        uint64_t h = ind.hash();
+        uint32 index;
+        if (find_hashed(ind, h, index))
             throw std::runtime_error("Index already in set");
+        // Update the number of neighbours of ind and of its parents
+        ind_t neighbors = 0;
+        mul_ind_t cur = ind;
+        for (ind_t j=0;j<m_max_dim;j++){
+            cur.step(j, 1);
+            neighbors += this->has_ind(cur);
+            cur.step(j, -1);
+        }
+        for (auto itr=ind.begin();itr!=ind.end();itr++){
+            cur.step(itr->ind, -1);
+            if (this->find_ind(cur, index))
+                m_neighbors[index]++;
+            cur.step(itr->ind, 1);
+        }
         m_ind_set.push_back(ind);
-        m_ind_map[ind] = m_ind_set.size()-1;
+        m_ind_hash.push_back(h);
+        m_neighbors.push_back(neighbors);
+        if (2*count() > m_hash_slots.size())
+            rehash(std::max<size_t>(16, 2*m_hash_slots.size()));
+        else
+            insert_slot(h, count()-1);
         m_max_dim = std::max(m_max_dim, ind.size());
     }
 
@@ -376,6 +512,7 @@ public:
     }
 
     double get_min_outer_profit(const PProfitCalculator profCalc) const;
+    void expand_to_profit(const PProfitCalculator profCalc, double max_prof);
     void check_admissibility(ind_t d_start, ind_t d_end,
                             unsigned char *admissible, uint32 count) const;
     void make_profits_admissible(ind_t d_start, ind_t d_end,
@@ -412,9 +549,74 @@ public:
     double estimate_bias(const double *err_contributions,
                          uint32 count, const double *rates, uint32 rates_size) const;
 protected:
+    // The indices are looked up in an open addressing hash table with linear
+    // probing. m_hash_slots has a power of two size and is at most half
+    // full, every slot is either 0 or one plus the position of an index in
+    // m_ind_set. m_ind_hash[i] is the hash of m_ind_set[i].
+    bool find_hashed(const mul_ind_t& cur, uint64_t h, uint32 &index) const{
+        if (m_hash_slots.empty())
+            return false;
+        size_t mask = m_hash_slots.size()-1;
+        for (size_t s=h & mask;;s=(s+1) & mask){
+            uint32 k = m_hash_slots[s];
+            if (k == 0)
+                return false;
+            if (m_ind_hash[k-1] == h && m_ind_set[k-1] == cur){
+                index = k-1;
+                return true;
+            }
+        }
+    }
+
+    void insert_slot(uint64_t h, uint32 index){
+        size_t mask = m_hash_slots.size()-1;
+        size_t s = h & mask;
+        while (m_hash_slots[s] != 0)
+            s = (s+1) & mask;
+        m_hash_slots[s] = index+1;
+    }
+
+    void rehash(size_t slots){
+        m_hash_slots.assign(slots, 0);
+        for (uint32 i=0;i<count();i++)
+            insert_slot(m_ind_hash[i], i);
+    }
+
+    // The indices outside the set whose parent m_ind_set[parent] is in the
+    // set, in a min-heap of their profits. The heap is only updated when the
+    // minimum profit is needed and includes the neighbours of the first
+    // processed indices of the set. Neighbours that were added to the set
+    // since are removed when they reach the top of the heap.
+    struct OuterProfits {
+        struct Entry {
+            double profit;
+            uint32 parent;
+            ind_t dim;
+            bool operator<(const Entry &rhs) const {
+                return profit > rhs.profit;   // std::*_heap are max-heaps
+            }
+        };
+        uint64_t prof_calc_id;
+        uint32 processed;
+        size_t compact_size;
+        std::vector<Entry> heap;
+    };
+    static const size_t MAX_OUTER_PROFITS = 4;
+    OuterProfits& outer_profits(const PProfitCalculator profCalc) const;
+    mul_ind_t outer_ind(const OuterProfits::Entry &e) const {
+        mul_ind_t cur = this->get(e.parent);
+        cur.step(e.dim, 1);
+        return cur;
+    }
+
     typedef std::vector<mul_ind_t> ind_vector;
     ind_vector  m_ind_set;
-    std::map<mul_ind_t, unsigned int> m_ind_map;
+    std::vector<uint64_t> m_ind_hash;
+    std::vector<uint32> m_hash_slots;
+    // m_neighbors[i] is the number of indices in the set that are
+    // m_ind_set[i] plus a unit vector, as returned by count_neighbors
+    std::vector<ind_t> m_neighbors;
+    mutable std::vector<OuterProfits> m_outer;
     ind_t m_max_dim;
 };
 
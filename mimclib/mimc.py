@@ -3,13 +3,15 @@ from __future__ import division
 from __future__ import print_function
 
 import time
+import os
 import copy
+import functools
 import gc
 import numpy as np
 import itertools
 import warnings
 from . import setutil
-from scipy.stats import norm
+from . import profiler
 
 __all__ = []
 import argparse
@@ -118,6 +120,327 @@ def compute_central_moment(psums, M, moment):
 Possible problem in computing sums.".format(moment, np.min(val)))
     return val
 
+# Run used by the worker processes of MIMCRun's pool. It is set before the
+# pool is created, so that forked workers inherit it instead of having to
+# unpickle the user functions.
+_pool_run = None
+
+def _pool_init():
+    # Forked workers inherit the random state of the parent, reseed so that
+    # they do not generate identical samples. Samplers with their own
+    # random state are reseeded through fnSeed, when it is provided.
+    np.random.seed()
+    if _pool_run is not None and hasattr(_pool_run.fn, "Seed"):
+        _pool_run.fn.Seed(np.random.randint(0, 2**32, size=4).astype(np.uint32))
+
+def _pool_sample_lvl(args):
+    job, offset, chunk_size = args
+    return _pool_run._sampleLvls([job], offsets=[offset],
+                                 chunk_sizes=[chunk_size])[0]
+
+def _pool_sample_chunk(args):
+    return _pool_run._sampleChunk(*args)
+
+def _lvl_key(lvl):
+    # Level without trailing zeros, so that the key does not depend on the
+    # dimension of the level
+    lvl = np.array(lvl, dtype=np.int).reshape(-1)
+    nz = np.nonzero(lvl)[0]
+    return tuple(lvl[:(nz[-1]+1 if len(nz) > 0 else 0)])
+
+@public
+def get_stream_key(seed, lvl, offset):
+    '''
+    Returns the key of the random stream used to generate the samples
+    of level lvl starting from the sample number offset. The key is an
+    array of uint32 that can be passed to np.random.seed.
+    '''
+    return np.array((seed, offset // 2**32, offset % 2**32) + _lvl_key(lvl),
+                    dtype=np.uint32)
+
+_korobov_cache = dict()
+
+def _korobov_param(N, dim):
+    # Parameter a of the Korobov generating vector (1, a, a^2, ...) mod N of
+    # a rank-1 lattice rule with N points, N a power of 2. It minimizes the
+    # P_2 criterion with weights 1/j^2 over a number of candidates that
+    # decreases with N, so that the search takes O(2^22) operations.
+    dim = np.minimum(dim, 16)
+    if N <= 2:
+        return 1
+    if (N, dim) in _korobov_cache:
+        return _korobov_cache[(N, dim)]
+    count = int(np.clip(2**22 // (N*dim), 4, 128))
+    cands = np.unique(2*np.linspace(0, N//4-1, np.minimum(count, N//4)).astype(np.int64)+1)
+    k = np.arange(N, dtype=np.int64)
+    weights = 1. / np.arange(1, dim+1)**2
+    best, best_err = 1, np.inf
+    for a in cands:
+        z = np.array([pow(int(a), j, N) for j in range(dim)], dtype=np.int64)
+        x = (np.outer(k, z) % N) / N
+        err = np.mean(np.prod(1 + weights * 2*np.pi**2 * (x**2 - x + 1./6),
+                              axis=1)) - 1
+        if err < best_err:
+            best, best_err = int(a), err
+    _korobov_cache[(N, dim)] = best
+    return best
+
+@public
+def lattice_points(N, dim, shift, start=0, count=None):
+    """
+    Returns the N points, in dim dimensions, of a rank-1 lattice rule with
+    a Korobov generating vector, shifted by shift and tent transformed.
+    N must be a power of 2 and shift must have at least dim entries.
+    If count is given, only the count points starting from the point
+    number start are returned.
+    """
+    if count is None:
+        count = N - start
+    a = _korobov_param(N, dim)
+    z = np.array([pow(a, j, N) for j in range(dim)], dtype=np.int64)
+    x = (np.outer(np.arange(start, start+count, dtype=np.int64), z) % N) / N \
+        + shift[:dim]
+    x -= np.floor(x)
+    # The tent transformation improves the convergence for integrands that
+    # are not periodic
+    return 1 - np.abs(2*x - 1)
+
+def _parse_bytes(v):
+    # Parses sizes like 512M or 4G
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    v = v.strip().upper().rstrip('B')
+    if v and v[-1] in units:
+        return int(float(v[:-1]) * units[v[-1]])
+    return int(float(v))
+
+def _batch_stream_key(seed, call):
+    # Key of the random stream of the call'th call to fnSampleLvls. The last
+    # entry cannot be part of a level, so the key differs from the ones
+    # returned by get_stream_key
+    return np.concatenate((get_stream_key(seed, [], call),
+                           [np.iinfo(np.uint32).max])).astype(np.uint32)
+
+def _shift_stream_key(key):
+    # Key of the random stream of the QMC shifts of the chunk whose samples
+    # are drawn from the stream key. Like in _batch_stream_key, the last
+    # entry cannot be part of a level
+    return np.concatenate((key, [np.iinfo(np.uint32).max-1])).astype(np.uint32)
+
+# Fields of MIMCItrData that are stored in a checkpoint
+_itr_arrays = ["M", "tT", "psums_delta", "psums_fine", "csums_delta",
+               "csums_fine", "Vl_estimate", "Wl_estimate"]
+_itr_scalars = ["bias", "stat_error", "TOL", "totalTime", "moments",
+                "_lvls_count"]
+
+def _itr_to_dict(itr, prefix):
+    data = dict()
+    for k in _itr_arrays + _itr_scalars:
+        v = getattr(itr, k)
+        if v is not None:
+            data[prefix + k] = np.asarray(v)
+    if itr.Q is not None:
+        data[prefix + "Q"] = np.array([itr.Q.getDict()], dtype=object)
+    return data
+
+def _itr_from_dict(data, prefix, lvls):
+    itr = MIMCItrData()
+    itr._lvls = lvls
+    for k in _itr_arrays:
+        setattr(itr, k, data[prefix + k].copy()
+                if prefix + k in data else None)
+    for k in _itr_scalars:
+        setattr(itr, k, data[prefix + k].item()
+                if prefix + k in data else None)
+    if prefix + "Q" in data:
+        itr.Q = Bunch(**data[prefix + "Q"][0])
+    return itr
+
+def _split_samples(M, maxM):
+    # Split M samples in chunks of at most maxM samples
+    if M <= 0:
+        return []
+    count = int(np.ceil(M / maxM))
+    return [maxM] * (count-1) + [M - maxM*(count-1)]
+
+def _sum_samples(a, b):
+    # a and b are tuples of (M, psums_delta, psums_fine, time,
+    # csums_delta, csums_fine)
+    ret = tuple(x + y for x, y in zip(a[:4], b[:4]))
+    return ret + tuple(None if x is None else merge_central_sums(a[0], x,
+                                                                 b[0], y)
+                       for x, y in zip(a[4:], b[4:]))
+
+def _tree_reduce(fn, items):
+    # Reduces items pairwise, i.e. ((0+1)+(2+3))+..., so that the order of
+    # the reduction only depends on the number of items
+    items = list(items)
+    while len(items) > 1:
+        items = [fn(items[i], items[i+1]) if i+1 < len(items) else items[i]
+                 for i in range(0, len(items), 2)]
+    return items[0]
+
+def _power_sums(x, moments):
+    # Returns sum_i x_i**p for p=1...moments. The powers are computed by
+    # in-place multiplications of a single copy of x, except for objects
+    # which only have to implement __pow__
+    psums = np.empty((moments,) + x.shape[1:], dtype=x.dtype)
+    if x.dtype == object:
+        for p in range(0, moments):
+            psums[p] = np.sum(x**(p+1), axis=0)
+        return psums
+    psums[0] = np.sum(x, axis=0)
+    if moments > 1:
+        xp = x.copy()
+        for p in range(1, moments):
+            xp *= x
+            psums[p] = np.sum(xp, axis=0)
+    return psums
+
+def _central_sums(x, moments):
+    # Returns the mean of x followed by sum_i (x_i-mean)**p for
+    # p=2...moments. Returns None for objects.
+    if x.dtype == object:
+        return None
+    csums = np.empty((moments,) + x.shape[1:],
+                     dtype=np.result_type(x.dtype, np.float))
+    csums[0] = np.mean(x, axis=0)
+    if moments > 1:
+        d = x - csums[0]
+        dp = d.copy()
+        for p in range(1, moments):
+            dp *= d
+            csums[p] = np.sum(dp, axis=0)
+    return csums
+
+def _delta_samples(values, mods):
+    if values.dtype == object:
+        return np.sum(values * mods.reshape((1, -1) + (1,)*(values.ndim-2)),
+                      axis=1)
+    if len(mods) == 1 and mods[0] == 1:
+        return values[:, 0]
+    return np.tensordot(values, mods.astype(values.dtype), axes=([1], [0]))
+
+@public
+def compute_sample_sums(values, mods, moments):
+    r'''
+    Returns the power sums, up to the given number of moments, of the
+    delta samples, \sum_{k} mods_k values_{:,k}, and of the fine samples,
+    values_{:,0}. values is an array of size (M, len(mods), ...)
+    '''
+    delta = _delta_samples(values, mods)
+    return _power_sums(delta, moments), _power_sums(values[:, 0], moments)
+
+@public
+def compute_sample_central_sums(values, mods, moments):
+    '''
+    Same as compute_sample_sums but returns the central sums, i.e. the
+    mean followed by the sums of the powers of the differences from the
+    mean. Returns None for objects.
+    '''
+    delta = _delta_samples(values, mods)
+    return _central_sums(delta, moments), _central_sums(values[:, 0], moments)
+
+_binom_tables = dict()
+
+def _binom_table(moments):
+    # Binomial coefficients C[p, k] for 0 <= k <= p <= moments, computed
+    # once for every number of moments
+    table = _binom_tables.get(moments)
+    if table is None:
+        table = np.zeros((moments+1, moments+1))
+        table[:, 0] = 1
+        for p in range(1, moments+1):
+            table[p, 1:] = table[p-1, 1:] + table[p-1, :-1]
+        _binom_tables[moments] = table
+    return table
+
+@public
+def merge_central_sums(Ma, csums_a, Mb, csums_b):
+    '''
+    Returns the central sums of the union of two sets of samples of
+    sizes Ma and Mb, given their central sums. The first axis of csums_a
+    and csums_b is the moment. Uses the formulas in
+    Pebay, "Formulas for robust, one-pass parallel computation of
+    covariances and arbitrary-order statistical moments", 2008.
+    '''
+    Ma = np.asarray(Ma, dtype=np.float)
+    Mb = np.asarray(Mb, dtype=np.float)
+    M = Ma + Mb
+    # Empty sets are replaced by a single sample in the divisions, their
+    # results are overwritten below
+    fa = Ma / np.maximum(M, 1)
+    fb = Mb / np.maximum(M, 1)
+    Ma_pos = np.maximum(Ma, 1)
+    Mb_pos = np.maximum(Mb, 1)
+    d = csums_b[0] - csums_a[0]
+    moments = csums_a.shape[0]
+    binom = _binom_table(moments)
+    # Powers are computed once rather than in the inner loop
+    d_pow = [d**k for k in range(moments)]
+    fa_pow = [fa**k for k in range(moments)]
+    fb_pow = [(-fb)**k for k in range(moments)]
+    csums = np.empty(np.broadcast(csums_a, csums_b, M).shape,
+                     dtype=np.result_type(csums_a, csums_b))
+    csums[0] = csums_a[0] + d * fb
+    for p in range(2, moments+1):
+        val = csums_a[p-1] + csums_b[p-1]
+        for k in range(1, p-1):
+            val += binom[p, k] * d_pow[k] * (fb_pow[k] * csums_a[p-k-1] +
+                                              fa_pow[k] * csums_b[p-k-1])
+        val += (Ma * fb * d)**p * (Mb_pos**(1.-p) - (-Ma_pos)**(1.-p))
+        csums[p-1] = val
+    # One of the sets might be empty
+    for M_empty, other in [(Mb == 0, csums_a), (Ma == 0, csums_b)]:
+        if np.any(M_empty):
+            M_empty = np.broadcast_to(M_empty, csums.shape[1:])
+            csums[:, M_empty] = np.broadcast_to(other, csums.shape)[:, M_empty]
+    return csums
+
+@public
+def psums_to_csums(psums, M):
+    '''
+    Converts power sums of levels, with the moment as the second axis, to
+    central sums. Since this uses binomial expansions, the result is only
+    as accurate as the power sums.
+    '''
+    M = np.array(M, dtype=np.float).reshape((-1,) + (1,)*(psums.ndim-2))
+    csums = np.zeros(psums.shape, dtype=np.result_type(psums.dtype, np.float))
+    mean = np.where(M == 0, 0, psums[:, 0] / np.maximum(M, 1))
+    csums[:, 0] = mean
+    binom = _binom_table(psums.shape[1])
+    mean_pow = [(-mean)**k for k in range(psums.shape[1]+1)]
+    for p in range(2, psums.shape[1]+1):
+        val = M * mean_pow[p]
+        for k in range(1, p+1):
+            val += binom[p, k] * psums[:, k-1] * mean_pow[p-k]
+        csums[:, p-1] = val
+    return csums
+
+@public
+def csums_to_psums(csums, M):
+    '''
+    Converts central sums of levels, with the moment as the second axis,
+    to power sums.
+    '''
+    M = _expand(np.array(M, dtype=np.float), 0, csums[:, 0].shape)
+    mean = csums[:, 0]
+    psums = np.empty_like(csums)
+    binom = _binom_table(csums.shape[1])
+    for p in range(1, csums.shape[1]+1):
+        val = M * mean**p
+        for k in range(2, p+1):
+            val += binom[p, k] * csums[:, k-1] * mean**(p-k)
+        psums[:, p-1] = val
+    return psums
+
+def _central_moment_from_csums(csums, M, moment):
+    # Same as compute_central_moment but uses central sums
+    if moment == 1:
+        val = csums[:, 0].copy()
+        val[M == 0] = None
+        return val
+    return compute_raw_moments(csums[:, moment-1:moment], M)[:, 0]
+
 def _expand(b, i, shape):
     assert(len(b) == shape[i])
     b_shape = np.ones(len(shape), dtype=np.int)
@@ -126,6 +449,36 @@ def _expand(b, i, shape):
     b_reps[i] = 1
     return np.tile(b.reshape(b_shape), b_reps)
 
+# Arrays of MIMCItrData that are shared with the next iteration until they
+# are modified
+_cow_fields = ["psums_delta", "psums_fine", "csums_delta", "csums_fine"]
+# Arrays of MIMCItrData with one row per level. They are stored with extra
+# rows, so that adding levels does not always copy them.
+_lvl_fields = _cow_fields + ["M", "tT", "Vl_estimate", "Wl_estimate"]
+# Arrays of MIMCItrData that are estimated from the others
+_estimate_fields = ["Vl_estimate", "Wl_estimate"]
+
+def _lvl_property(name):
+    def fset(self, value):
+        if name not in _estimate_fields:
+            self._dirty = None
+        self._setArray(name, value)
+    return property(lambda self: self._readArray(name), fset)
+
+def _cached_stat(fn):
+    # Caches the result of a method of MIMCItrData until the samples or the
+    # levels change. Cached arrays are read-only.
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        key = (fn.__name__,) + args + tuple(sorted(kwargs.items()))
+        if key not in self._stats:
+            val = fn(self, *args, **kwargs)
+            if isinstance(val, np.ndarray):
+                val.setflags(write=False)
+            self._stats[key] = val
+        return self._stats[key]
+    return wrapper
+
 @public
 class MIMCItrData(object):
     """
@@ -135,13 +488,38 @@ class MIMCItrData(object):
 
     In a MIMC Run object, the data is stored in a MIMCItrData object
 
+    The sums of an iteration are shared with the iteration returned by
+    next_itr. Before the latter modifies a level, the old values of the
+    level are saved in the previous iterations, so the memory grows with
+    the modified levels instead of the number of iterations. Reading the
+    sums of an iteration that has a next iteration returns a new copy, so
+    they should only be modified through the methods of this class.
     """
+    psums_delta = _lvl_property("psums_delta")
+    psums_fine = _lvl_property("psums_fine")
+    csums_delta = _lvl_property("csums_delta")
+    csums_fine = _lvl_property("csums_fine")
+    M = _lvl_property("M")
+    tT = _lvl_property("tT")
+    Vl_estimate = _lvl_property("Vl_estimate")
+    Wl_estimate = _lvl_property("Wl_estimate")
 
     def __init__(self, min_dim=0, moments=None, lvls=None):
+        self._lvls_count = 0
+        self._arrays = dict()
+        # Levels count and saved levels of the arrays that are shared with
+        # the next iterations
+        self._saved = dict()
+        self._prev = None
+        self._stats = dict()
         self.moments = moments
         self._lvls = lvls or setutil.VarSizeList(min_dim=min_dim)
         self.psums_delta = None
         self.psums_fine = None
+        # Mean followed by sums of powers of differences from the mean.
+        # These are None for objects.
+        self.csums_delta = None
+        self.csums_fine = None
         self.tT = np.zeros(0)      # Time of lvls
         self.M = np.zeros(0, dtype=np.int)      # Number of samples in each lvl
         self.bias = np.inf           # Approximation of the discretization error
@@ -149,17 +527,29 @@ class MIMCItrData(object):
         self.TOL = None              # Target tolerance
         self.totalTime = None
         self.Q = None
+        self.profile = None          # Collected by MIMCRun.profiler
         self.Vl_estimate = np.zeros(0)
         self.Wl_estimate = np.zeros(0)
-        self._lvls_count = 0
         self._levels_added()
+        # Levels that were added or sampled since the last call to
+        # _popDirty, None if all levels are considered modified
+        self._dirty = None
 
     def next_itr(self):
         ret = MIMCItrData(moments=self.moments,
                           lvls=self._lvls)
         ret._lvls_count = self._lvls_count
-        ret.psums_delta = self.psums_delta.copy() if self.psums_delta is not None else None
-        ret.psums_fine = self.psums_fine.copy() if self.psums_fine is not None else None
+        ret._prev = self
+        for name in _cow_fields:
+            arr = self._arrays.get(name)
+            if arr is None:
+                continue
+            if name in self._saved:
+                # Already shared with another iteration that modifies it
+                ret._arrays[name] = self._readArray(name)
+            else:
+                ret._arrays[name] = arr
+                self._saved[name] = (self._lvls_count, dict())
         ret.tT = self.tT.copy()
         ret.M = self.M.copy()
         ret.bias = self.bias
@@ -169,9 +559,61 @@ class MIMCItrData(object):
         ret.Q = copy.copy(self.Q)
         ret.Vl_estimate = self.Vl_estimate.copy() if self.Vl_estimate is not None else None
         ret.Wl_estimate = self.Wl_estimate.copy() if self.Wl_estimate is not None else None
+        ret._dirty = None if self._dirty is None else set(self._dirty)
         return ret
 
 
+    def _readArray(self, name):
+        arr = self._arrays.get(name)
+        if arr is None:
+            return None
+        if name not in self._saved:
+            return arr[:self._lvls_count]
+        count, saved = self._saved[name]
+        arr = arr[:count].copy()
+        for k, v in saved.items():
+            arr[k] = v
+        return arr
+
+    def _setArray(self, name, value):
+        self._stats.clear()
+        self._saved.pop(name, None)
+        self._arrays[name] = value
+
+    def _markDirty(self, ind):
+        if self._dirty is not None:
+            self._dirty.update(np.arange(self._lvls_count)[ind].reshape(-1).tolist())
+
+    def _popDirty(self):
+        dirty, self._dirty = self._dirty, set()
+        return None if dirty is None else np.array(sorted(dirty), dtype=np.int)
+
+    def _prepareWrite(self, rows=None):
+        # Makes the sums owned by this iteration, or by this iteration and
+        # previous ones. In the latter case, the rows that are about to be
+        # modified are saved in the previous iterations.
+        if rows is not None and self._prev is not None:
+            rows = np.arange(self._lvls_count)[rows].reshape(-1).tolist()
+        else:
+            rows = []
+        for name in _cow_fields:
+            if name in self._saved:
+                self._setArray(name, self._readArray(name))
+            arr = self._arrays.get(name)
+            if arr is None:
+                continue
+            for k in rows:
+                old = None
+                itr = self._prev
+                while itr is not None:
+                    if itr._arrays.get(name) is arr and name in itr._saved:
+                        count, saved = itr._saved[name]
+                        if k < count and k not in saved:
+                            old = arr[k].copy() if old is None else old
+                            saved[k] = old
+                    itr = itr._prev
+
+    @_cached_stat
     def calcEg(self):
         """
         Return the sum of the sample estimators for
@@ -182,6 +624,7 @@ class MIMCItrData(object):
     def computedMoments(self):
         return self.moments
 
+    @_cached_stat
     def calcDeltaVl(self):
         if self.moments < 2:
             vl = np.empty(self.lvls_count)
@@ -189,6 +632,19 @@ class MIMCItrData(object):
             return vl
         return self.calcDeltaCentralMoment(2)
 
+    def calcDeltaVl_lvls(self, ind):
+        """
+        Same as calcDeltaVl()[ind] but only computes the levels ind
+        """
+        if self.moments < 2:
+            vl = np.empty(len(ind))
+            vl.fill(np.nan)
+            return vl
+        if self.csums_delta is None:
+            return compute_central_moment(self.psums_delta[ind], self.M[ind], 2)
+        return _central_moment_from_csums(self.csums_delta[ind], self.M[ind], 2)
+
+    @_cached_stat
     def calcDeltaEl(self, moment=1):
         '''
         Returns the sample estimators for moments
@@ -204,12 +660,19 @@ class MIMCItrData(object):
         val[np.logical_not(idx)] = None
         return val
 
+    @_cached_stat
     def calcDeltaCentralMoment(self, moment):
-        return compute_central_moment(self.psums_delta, self.M, moment)
+        if self.csums_delta is None:
+            return compute_central_moment(self.psums_delta, self.M, moment)
+        return _central_moment_from_csums(self.csums_delta, self.M, moment)
 
+    @_cached_stat
     def calcFineCentralMoment(self, moment):
-        return compute_central_moment(self.psums_delta, self.M, moment)
+        if self.csums_fine is None:
+            return compute_central_moment(self.psums_fine, self.M, moment)
+        return _central_moment_from_csums(self.csums_fine, self.M, moment)
 
+    @_cached_stat
     def calcTl(self):
         idx = self.M != 0
         val = np.zeros_like(self.M, dtype=np.float)
@@ -219,48 +682,122 @@ class MIMCItrData(object):
     def calcTotalTime(self, ind=None):
         return np.sum(self.tT, axis=0)
 
-    def addSamples(self, lvl_idx, M, psums_delta, psums_fine, tT):
+    def addSamples(self, lvl_idx, M, psums_delta, psums_fine, tT,
+                   csums_delta=None, csums_fine=None):
+        if csums_delta is not None or csums_fine is not None or \
+           self._arrays.get("csums_delta") is not None or \
+           self._arrays.get("csums_fine") is not None:
+            self.addSamples_many([lvl_idx], [M], psums_delta[None],
+                                 psums_fine[None], [tT],
+                                 None if csums_delta is None else csums_delta[None],
+                                 None if csums_fine is None else csums_fine[None])
+            return
+        # Only power sums are kept, they are accumulated directly
         assert psums_delta.shape == psums_fine.shape and \
             psums_fine.shape[0] == self.computedMoments(), "Inconsistent arguments "
-        #assert lvl_idx is not None, "Level was not found"
-        if self.M[lvl_idx] == 0:
-            if self.psums_delta is None:
-                self.psums_delta = np.zeros((self.lvls_count,)
-                                            + psums_delta.shape, dtype=psums_delta.dtype)
-
-            if self.psums_fine is None:
-                self.psums_fine = np.zeros((self.lvls_count,)
-                                            + psums_fine.shape, dtype=psums_fine.dtype)
-
-            self.psums_delta[lvl_idx] = psums_delta
-            self.psums_fine[lvl_idx] = psums_fine
-            self.M[lvl_idx] = M
-            self.tT[lvl_idx] = tT
-        else:
-            self.psums_delta[lvl_idx] += psums_delta
-            self.psums_fine[lvl_idx] += psums_fine
-            self.M[lvl_idx] += M
-            self.tT[lvl_idx] += tT
-        if psums_delta.dtype != self.psums_delta.dtype:
-            self.psums_delta = self.psums_delta.astype(psums_delta.dtype)
-        if psums_fine.dtype != self.psums_fine.dtype:
-            self.psums_fine = self.psums_fine.astype(psums_fine.dtype)
+        self._stats.clear()
+        for name, val in [("psums_delta", psums_delta),
+                          ("psums_fine", psums_fine)]:
+            if self._arrays.get(name) is None:
+                self._setArray(name, np.zeros((self.lvls_count,) + val.shape,
+                                              dtype=val.dtype))
+        self._prepareWrite(lvl_idx)
+        self._markDirty(lvl_idx)
+        new = self.M[lvl_idx] == 0
+        for name, val in [("psums_delta", psums_delta),
+                          ("psums_fine", psums_fine)]:
+            arr = getattr(self, name)
+            if new:
+                arr[lvl_idx] = val
+            else:
+                arr[lvl_idx] += val
+            if val.dtype != arr.dtype:
+                self._setArray(name, arr.astype(val.dtype))
+        self.tT[lvl_idx] = tT if new else self.tT[lvl_idx] + tT
+        self.M[lvl_idx] += M
+
+    def addSamples_many(self, lvl_indices, M, psums_delta, psums_fine, tT,
+                        csums_delta=None, csums_fine=None):
+        """
+        Adds the sums of samples of several distinct levels. The first axis
+        of all arguments runs over lvl_indices, otherwise they are the
+        same as the arguments of addSamples.
+        """
+        lvl_indices = np.array(lvl_indices, dtype=np.int).reshape(-1)
+        M = np.array(M, dtype=np.int).reshape(-1)
+        tT = np.array(tT, dtype=np.float).reshape(-1)
+        assert psums_delta.shape == psums_fine.shape and \
+            psums_fine.shape[:2] == (len(lvl_indices), self.computedMoments()) \
+            and len(M) == len(lvl_indices) and len(tT) == len(lvl_indices), \
+            "Inconsistent arguments "
+        assert len(np.unique(lvl_indices)) == len(lvl_indices), \
+            "Levels must be distinct"
+        self._stats.clear()
+        if psums_delta.dtype != object:
+            # Legacy sums, for example from the database, are only converted
+            # when central sums are kept
+            if csums_delta is None and \
+               self._arrays.get("csums_delta") is not None:
+                csums_delta = psums_to_csums(psums_delta, M)
+            if csums_fine is None and \
+               self._arrays.get("csums_fine") is not None:
+                csums_fine = psums_to_csums(psums_fine, M)
+        if self._arrays.get("psums_delta") is None:
+            for name, val in [("psums_delta", psums_delta),
+                              ("psums_fine", psums_fine),
+                              ("csums_delta", csums_delta),
+                              ("csums_fine", csums_fine)]:
+                if val is not None:
+                    self._setArray(name, np.zeros((self.lvls_count,) +
+                                                  val.shape[1:], dtype=val.dtype))
+
+        self._prepareWrite(lvl_indices)
+        self._markDirty(lvl_indices)
+        old_M = self.M[lvl_indices]
+        new = old_M == 0
+        for name, val in [("csums_delta", csums_delta),
+                          ("csums_fine", csums_fine)]:
+            arr = getattr(self, name)
+            if arr is None:
+                continue
+            shape = (-1,) + (1,)*(val.ndim-2)
+            arr[lvl_indices] = np.swapaxes(merge_central_sums(
+                old_M.reshape(shape), np.swapaxes(arr[lvl_indices], 0, 1),
+                M.reshape(shape), np.swapaxes(val, 0, 1)), 0, 1)
+        for name, val in [("psums_delta", psums_delta),
+                          ("psums_fine", psums_fine)]:
+            arr = getattr(self, name)
+            arr[lvl_indices[new]] = val[new]
+            arr[lvl_indices[~new]] += val[~new]
+            if val.dtype != arr.dtype:
+                self._setArray(name, arr.astype(val.dtype))
+        self.M[lvl_indices] = old_M + M
+        self.tT[lvl_indices] = np.where(new, tT, self.tT[lvl_indices] + tT)
 
     def _levels_added(self):
         new_count = len(self._lvls)
         assert(new_count >= self._lvls_count)
         if new_count == self._lvls_count:
             return  # Levels were not really added
+        self._stats.clear()
+        self._prepareWrite()
+        old_count = self._lvls_count
+        for name in _lvl_fields:
+            arr = self._arrays.get(name)
+            if arr is None:
+                continue
+            if arr.shape[0] >= new_count:
+                arr[old_count:new_count] = 0
+                continue
+            # The capacity is doubled, so that adding levels one at a time
+            # only copies the arrays a logarithmic number of times
+            new = np.zeros((np.maximum(new_count, 2*arr.shape[0]),)
+                           + arr.shape[1:], dtype=arr.dtype)
+            count = np.minimum(old_count, arr.shape[0])
+            new[:count] = arr[:count]
+            self._arrays[name] = new
         self._lvls_count = new_count
-        if self.psums_delta is not None:
-            self.psums_delta.resize((new_count, ) + self.psums_delta.shape[1:], refcheck=False)
-        if self.psums_fine is not None:
-            self.psums_fine.resize((new_count, ) + self.psums_fine.shape[1:], refcheck=False)
-
-        self.Vl_estimate.resize(new_count, refcheck=False)
-        self.Wl_estimate.resize(new_count, refcheck=False)
-        self.tT.resize(new_count, refcheck=False)
-        self.M.resize(new_count, refcheck=False)
+        self._markDirty(slice(old_count, new_count))
 
     def calcTotalWork(self):
         return np.sum(self.Wl_estimate * self.M, axis=0)
@@ -269,6 +806,7 @@ class MIMCItrData(object):
         return self.bias + (self.stat_error if not np.isnan(self.stat_error) else 0)
 
     def zero_samples(self, ind=None):
+        self._stats.clear()
         if ind is None:
             self.M = np.zeros_like(self.M)
             self.tT = np.zeros_like(self.tT)
@@ -276,13 +814,23 @@ class MIMCItrData(object):
                 self.psums_delta = np.zeros_like(self.psums_delta)
             if self.psums_fine is not None:
                 self.psums_fine = np.zeros_like(self.psums_fine)
+            if self.csums_delta is not None:
+                self.csums_delta = np.zeros_like(self.csums_delta)
+            if self.csums_fine is not None:
+                self.csums_fine = np.zeros_like(self.csums_fine)
         else:
+            self._prepareWrite(ind)
+            self._markDirty(ind)
             self.M[ind] = 0
             self.tT[ind] = 0
             if self.psums_delta is not None:
                 self.psums_delta[ind, :] = np.zeros_like(self.psums_delta[ind, :])
             if self.psums_fine is not None:
                 self.psums_fine[ind, :] = np.zeros_like(self.psums_fine[ind, :])
+            if self.csums_delta is not None:
+                self.csums_delta[ind, :] = 0
+            if self.csums_fine is not None:
+                self.csums_fine[ind, :] = 0
 
     @property
     def lvls_count(self):
@@ -300,7 +848,7 @@ class MIMCItrData(object):
 
     def lvls_find(self, ind, j=None):
         i = self._lvls.find(ind=ind, j=j)
-        return i if i < self.lvls_count else None
+        return i if i is not None and i < self.lvls_count else None
 
     def lvls_get(self, i):
         assert i < self.lvls_count
@@ -349,6 +897,15 @@ class MIMCRun(object):
                         Norm=np.abs)
         self.params = Bunch(**kwargs)
         self.iters = []
+        self._pool = None
+        self._drawn = dict()     # Number of samples drawn in every level
+        self._batch_calls = 0    # Number of calls to fnSampleLvls
+        self._qmc_N = dict()     # Number of lattice points of every level
+        self._boundary = None    # Boundary levels of the last bias estimate
+        self.profiler = profiler.NullProfiler()
+        # Time and memory per sample of every level, used to choose the
+        # chunk sizes
+        self._lvl_cost = dict()
         dims = np.array([len(getattr(self.params, a))
                 for a in ["w", "s", "gamma", "beta"] if hasattr(self.params, a)])
         if len(dims) > 0 and np.any(dims != dims[0]):
@@ -398,6 +955,10 @@ class MIMCRun(object):
     def _checkFunctions(self):
         # If self.params.reuse_samples is True then
         # all_itr will always equal last_itr
+        if not hasattr(self.fn, "WorkModel") and \
+           getattr(self.params, "calibrate_work", False):
+            self.fn.WorkModel = self._calibratedWorkModel
+
         if not hasattr(self.fn, "WorkModel") and hasattr(self.params, "gamma"):
             self.fn.WorkModel = lambda lvls: work_estimate(lvls,
                                                           np.log(self.params.beta) *
@@ -413,37 +974,76 @@ class MIMCRun(object):
 supported with a given work model")
 
         if not hasattr(self.fn, "WorkModel"):
-            # ADDING WORK MODEL B
             warnings.warn("fnWorkModel is not provided, using run-time estimates.")
-            raise NotImplemented("Need to check that the lvls \
-are the same as the argument ones")
-            self.fn.WorkModel = lambda lvls: self.Tl()
+            self.fn.WorkModel = self._calibratedWorkModel
+
+        if getattr(self.fn, "SampleLvl", None) is None and \
+           not hasattr(self.fn, "SampleLvls"):
+            raise ValueError("Must set the sampling functions fnSampleLvl \
+or fnSampleLvls")
+
+        if getattr(self.params, "qmc", False):
+            if hasattr(self.fn, "SampleLvls"):
+                raise ValueError("fnSampleLvls is not supported in QMC mode")
+            N0 = self.params.qmc_N0
+            if N0 < 1 or N0 & (N0-1) != 0:
+                raise ValueError("qmc_N0 must be a power of 2")
+            if self.params.moments < 2:
+                raise ValueError("QMC mode needs at least 2 moments")
+
+        progressive = getattr(self.params, "progressive", 1.)
+        if not 0 < progressive <= 1:
+            raise ValueError("progressive must be in (0, 1]")
 
-        if self.fn.SampleLvl is None:
-            raise ValueError("Must set the sampling functions fnSampleLvl")
+        if hasattr(self.params, "seed") and not hasattr(self.fn, "Seed"):
+            self.fn.Seed = np.random.seed
 
         if not hasattr(self.fn, "ExtendLvls"):
+            if not hasattr(self.params, "gamma"):
+                raise ValueError("gamma is needed by the default fnExtendLvls, \
+set gamma or provide fnExtendLvls")
             weights = self.params.beta * (self.params.w +
                                           (self.params.s -
                                            self.params.gamma)/2.)
             weights /= np.sum(weights, axis=0)
             profCalc = setutil.TDProfCalculator(weights)
+            incremental = getattr(self.params, "incremental_expand", False)
             self.fn.ExtendLvls = lambda lvls: extend_prof_lvls(lvls, profCalc,
-                                                               self.params.min_lvls)
+                                                               self.params.min_lvls,
+                                                               incremental)
 
     def setFunctions(self, **kwargs):
-        # fnSampleLvl(moments, mods, inds, M):
-        #    Returns M, array: M sums of mods*inds, and total
-        #    (linear) time it took to compute them
+        # fnSampleLvl(inds, M):
+        #    Returns an array of M samples of all inds, and the total
+        #    (linear) time it took to compute them. It can also return an
+        #    iterator, e.g. be a generator, over (values, time) batches
+        #    that together contain the M samples. Every batch is reduced
+        #    to sums before the next one is requested.
+        # fnSampleLvls(requests): Optional, used instead of fnSampleLvl.
+        #    requests is a list of (lvl, inds, mods, M) of all levels that
+        #    need samples. Returns a list with what fnSampleLvl would return
+        #    for every request. This allows sharing setup costs between
+        #    levels. Note that if the random inputs are shared too, samples
+        #    of different levels are correlated, which is ignored when
+        #    estimating the statistical error.
         # fnItrDone(i, TOLs, totalTime): Called at the end of iteration
         #    i out of TOLs
         # fnWorkModel(lvls): Returns work estimate of lvls
         # fnHierarchy(lvls): Returns associated hierarchy of lvls
+        # fnSeed(key): Called before fnSampleLvl when the run has a seed.
+        #    key is an array of uint32 identifying the random stream of the
+        #    samples, see get_stream_key. Default is np.random.seed. It is
+        #    also called with a random key in every worker process, see
+        #    workers. Samplers that keep their own random state must
+        #    provide it, otherwise all workers draw identical samples.
+        # fnProfile(event): Called with a dictionary for every profiled span
+        #    and counter, see profiler.Profiler. Setting it enables profiling
         for k in kwargs.keys():
             kk = k[2:] if k.startswith('fn') else k
-            if kk not in ["SampleLvl", "ExtendLvls",
+            if kk not in ["SampleLvl", "SampleLvls", "ExtendLvls",
                          "ItrDone", "WorkModel",
-                         "Hierarchy", "SampleQoI", "Norm"]:
+                         "Hierarchy", "SampleQoI", "Norm", "Seed",
+                         "Profile"]:
                 raise KeyError("Invalid function name")
             setattr(self.fn, kk, kwargs[k])
 
@@ -534,9 +1134,82 @@ sample variance on levels when not using the Bayesian estimators. \
 Not needed if a profit calculator is provided.")
             add_store('maxM', type=int, default=100000, help="Maximum number of \
 samples to compute per call to user function")
+            add_store('progressive', type=float, default=1.,
+                      help="Fraction of the missing samples that is computed \
+before the variances are estimated again and the number of samples is \
+recomputed. This avoids overshooting the number of samples when the \
+variances are estimated with few samples. 1 computes all samples at once.")
+            add_store('mem_budget', type=_parse_bytes,
+                      help="Maximum memory, in bytes, of the samples computed \
+per call to user function. Suffixes K, M, G and T are allowed. The memory per \
+sample of a level is measured in previous calls. Not needed if maxM is small \
+enough.")
+            add_store('chunk_time', type=float,
+                      help="Target time, in seconds, of every call to user \
+function. The time per sample of a level is measured in previous calls. Since \
+this makes the sizes of the calls depend on timings, runs with a seed are not \
+reproducible with this option.")
+            add_store('workers', type=int, default=1, help="Number of worker \
+processes used to sample different levels in parallel. Values larger than 1 \
+require a platform where processes can be forked. Every worker is reseeded \
+through fnSeed, which must be provided if fnSampleLvl does not use np.random.")
+            add_store('par_chunks', type='bool', default=False,
+                      help="Distribute chunks of at most maxM samples, instead \
+of whole levels, among the worker processes. Not needed if workers is 1.")
+            add_store('checkpoint', type=str,
+                      help="Path of a file where the state of the run is \
+saved after iterations. If the file exists when the run starts, the run \
+continues from the saved state.")
+            add_store('checkpoint_interval', type=float, default=0,
+                      help="Minimum time, in seconds, between two saves of \
+the state of the run. Not needed if checkpoint is not provided.")
+            add_store('calibrate_work', type='bool', default=False,
+                      help="Use a model a + b*exp(gamma.l) of the time per \
+sample of the levels, fitted to the measured times in every iteration, \
+instead of work_estimate. gamma is fitted as well if it is not provided, in \
+which case fnExtendLvls must be provided. Not needed if fnWorkModel is \
+provided.")
+            add_store('qmc', type='bool', default=False,
+                      help="Use randomly shifted lattice rules instead of \
+independent samples. fnSampleLvl is called with an additional argument \
+points, such that points(dim) returns the M lattice points in [0,1]^dim to \
+be used for the M samples. The samples of a level are the averages over \
+qmc_shifts independent shifts and the statistical error is reduced by \
+doubling the number of points of the levels.")
+            add_store('qmc_shifts', type=int, default=16,
+                      help="Number of random shifts of every level in QMC \
+mode. Not needed if qmc is False.")
+            add_store('qmc_N0', type=int, default=1,
+                      help="Initial number of lattice points of every level in \
+QMC mode, a power of 2. Not needed if qmc is False.")
+            add_store('qmc_max_N', type=int, default=2**20,
+                      help="Maximum number of lattice points of every level \
+in QMC mode. Not needed if qmc is False.")
+            add_store('max_time', type=float,
+                      help="Time budget, in seconds, of the run. The run \
+stops before an iteration that is expected to exceed it. In QMC mode, it stops \
+once the budget is exceeded.")
+            add_store('max_work', type=float,
+                      help="Work budget of the run, in the units of the work \
+model. The run stops before an iteration that is expected to exceed it. In QMC \
+mode, it stops once the budget is exceeded.")
+            add_store('profile', type='bool', default=False,
+                      help="Measure the time spent in the phases of every \
+iteration, such as sampling, estimation and extending the levels. The results \
+are stored in the profile attribute of every iteration.")
+            add_store('profile_json', type=str,
+                      help="Path of a JSON file where the profiles of all \
+iterations are saved at the end of the run. Enables profiling.")
+            add_store('profile_trace', type=str,
+                      help="Path of a Chrome trace file where all profiled \
+spans are saved at the end of the run. Enables profiling.")
             add_store('min_lvls', type=int, default=3,
                       help="The initial number of levels to run \
 the first iteration. Not needed if a profit calculator is provided.")
+            add_store('incremental_expand', type='bool', default=False,
+                      help="Extend the index set from its outer indices \
+instead of building it again every time it is extended. Gives the same set \
+when the profits increase with the indices.")
             add_store('max_add_itr', type=int, default=2,
                       help="Maximum number of additonal iterations\
 to run when the MIMC is expected to but is not converging.\
@@ -598,6 +1271,7 @@ Bias={:.12e}\nStatErr={:.12e}\
         V = self.Vl_estimate[self.last_itr.lvls_find([])]
         if np.isnan(V):
             return np.nan
+        from scipy.stats import norm
         Ca = norm.ppf(self.params.confidence)
         return np.maximum(np.reshape(self.params.M0, (1,))[-1],
                           int(np.ceil((theta * TOL / Ca)**-2 * V)))
@@ -697,61 +1371,268 @@ estimate optimal number of levels"
         return minL
 
     ################## END: Bayesian specific function
+    def _calibratedWorkModel(self, lvls):
+        # Time per sample of lvls, from a model fitted to the measured times
+        # of the levels that have samples. It is refitted on every call.
+        gamma = np.log(self.params.beta) * self.params.gamma \
+                if hasattr(self.params, "gamma") else None
+        itr = self.all_itr
+        # Levels that are too cheap for the timer are not used in the fit
+        sampled = np.nonzero((itr.M > 0) & (itr.calcTl() > 0))[0]
+        if len(sampled) == 0:
+            return work_estimate(lvls, gamma) if gamma is not None \
+                else np.ones(len(lvls))
+        data = itr._lvls.sublist(sampled)
+        d = np.maximum(np.maximum(lvls.max_dim(), data.max_dim()), 1)
+        a, b, gamma = fit_work_model(data.to_dense_matrix(d_end=d),
+                                     itr.calcTl()[sampled], gamma)
+        return a + b * np.exp(lvls.to_dense_matrix(d_end=d).dot(gamma))
+
     def _estimateAll(self):
-        self._estimateQParams()
-        self.iters[-1].Vl_estimate = self.fn.Norm(self.all_itr.calcDeltaVl()) \
-                                     if not self.params.bayesian \
-                                        else self._estimateBayesianVl()
-        self.iters[-1].Wl_estimate = self.fn.WorkModel(lvls=self.last_itr.get_lvls())
-        self.iters[-1].bias = self._estimateBias()
-        Ca = norm.ppf(self.params.confidence)
-        self.iters[-1].stat_error = np.inf if np.any(self.last_itr.M == 0) \
-                                    else Ca * \
-                                         np.sqrt(np.sum(self.Vl_estimate / self.last_itr.M))
+        with self.profiler.span("estimate"):
+            self._estimateQParams()
+            itr = self.last_itr
+            # Only the levels that were added or sampled since the last call
+            # are estimated again. All of them are estimated when dirty is
+            # None.
+            dirty = itr._popDirty()
+            if self.all_itr is not itr:
+                self.all_itr._popDirty()
+                dirty = None
+            if self.params.bayesian:
+                itr.Vl_estimate = self._estimateBayesianVl()
+            elif dirty is None:
+                # fnNorm might return the array cached by calcDeltaVl, which
+                # is read-only
+                itr.Vl_estimate = np.array(self.fn.Norm(self.all_itr.calcDeltaVl()),
+                                           copy=True)
+            elif len(dirty) > 0:
+                itr.Vl_estimate[dirty] = self.fn.Norm(itr.calcDeltaVl_lvls(dirty))
+
+            # The calibrated work model is fitted again to all levels
+            rows = dirty if dirty is not None and \
+                   self.fn.WorkModel != self._calibratedWorkModel \
+                   else np.arange(itr.lvls_count)
+            if len(rows) > 0:
+                lvls = itr.get_lvls()
+                Wl = self.fn.WorkModel(lvls=lvls if len(rows) == len(lvls)
+                                       else lvls.sublist(rows))
+                if getattr(self.params, "qmc", False):
+                    # Work of a shift
+                    Wl = Wl * np.array([self._qmcPoints(lvls[i]) for i in rows])
+                if len(rows) == itr.lvls_count:
+                    itr.Wl_estimate = Wl
+                else:
+                    itr.Wl_estimate[rows] = Wl
+
+            # Only the errors of boundary levels contribute to the bias, so
+            # it is kept when the levels did not change and no boundary level
+            # was sampled.
+            if self.params.bayesian or dirty is None or \
+               self._boundary is None or len(self._boundary) != itr.lvls_count:
+                if not self.params.bayesian:
+                    self._boundary = itr.get_lvls().is_boundary()
+                itr.bias = self._estimateBias()
+            elif np.any(self._boundary[dirty]):
+                itr.bias = self._estimateBias()
+            from scipy.stats import norm
+            Ca = norm.ppf(self.params.confidence)
+            itr.stat_error = np.inf if np.any(itr.M == 0) \
+                             else Ca * np.sqrt(np.sum(itr.Vl_estimate / itr.M))
 
     def _extendLevels(self, new_lvls=None):
         prev = self.last_itr.lvls_count
-        if new_lvls is not None:
-            self.last_itr.lvls_add_from_list(new_lvls)
-        else:
-            self.fn.ExtendLvls(lvls=self.last_itr.get_lvls())
-            self.last_itr._levels_added()
-
-        self.all_itr._levels_added()
+        with self.profiler.span("extend_levels"):
+            if new_lvls is not None:
+                self.last_itr.lvls_add_from_list(new_lvls)
+            else:
+                self.fn.ExtendLvls(lvls=self.last_itr.get_lvls())
+                self.last_itr._levels_added()
+            self.all_itr._levels_added()
         assert(prev != self.last_itr.lvls_count)
+        self.profiler.count("levels", int(self.last_itr.lvls_count - prev))
         newTodoM = self.params.M0
+        if getattr(self.params, "qmc", False):
+            newTodoM = np.array([self.params.qmc_shifts])
         if len(newTodoM) < self.last_itr.lvls_count:
             newTodoM = np.pad(newTodoM,
                               (0,self.last_itr.lvls_count-len(newTodoM)), 'constant',
                               constant_values=newTodoM[-1])
         return np.concatenate((self.last_itr.M[:prev], newTodoM[prev:self.last_itr.lvls_count]))
 
-    #@profile
-    def SampleLvl(self, mods, inds, M):
+    def _sampleChunk(self, mods, inds, M, key=None, N=None, maxN=None):
         # fnSampleLvl(inds, M) -> Returns a matrix of size (M, len(ind)) and
         # the time estimate
-        calcM = 0
-        total_time = 0
-        p = np.arange(1, self.last_itr.computedMoments()+1)
-        psums_delta = _empty_obj()
-        psums_fine = _empty_obj()
-        while calcM < M:
-            curM = np.minimum(M-calcM, self.params.maxM)
-            values, samples_time = self.fn.SampleLvl(inds=inds, M=curM)
-            total_time += samples_time
-            # psums_delta_j = \sum_{i} (\sum_{k} mod_k values_{i,k})**p_j
-
-            delta = np.sum(values * \
-                           _expand(mods, 1, values.shape),
-                           axis=1)
-            A1 = np.tile(delta, (len(p),) + (1,)*len(delta.shape) )
-            A2 = np.tile(values[:, 0], (len(p),) + (1,)*len(delta.shape) )
-            B = _expand(p, 0, A1.shape)
-            psums_delta += np.sum(A1**B, axis=1)
-            psums_fine += np.sum(A2**B, axis=1)
-            calcM += values.shape[0]
-
-        return calcM, psums_delta, psums_fine, total_time
+        if key is not None:
+            self.fn.Seed(key)
+        if N is not None:
+            return self._reduceBatches(mods, self._sampleShifts(inds, M, N,
+                                                                key, maxN))
+        return self._reduceBatches(mods, self.fn.SampleLvl(inds=inds, M=M))
+
+    def _sampleShifts(self, inds, M, N, key=None, maxN=None):
+        # Used instead of fnSampleLvl in QMC mode. Every one of the M samples
+        # is the average of fnSampleLvl over a lattice rule with N points and
+        # an independent random shift. fnSampleLvl is called with at most
+        # maxN of the points at a time. The shifts are drawn from a different
+        # stream than the one passed to fnSeed.
+        rand = np.random if key is None \
+               else np.random.RandomState(_shift_stream_key(key))
+        maxN = N if maxN is None else maxN
+        values, total_time = [], 0.
+        for i in range(0, M):
+            shift = [np.zeros(0)]
+            total, count = None, 0
+            for start in range(0, N, maxN):
+                def points(dim, start=start, curN=min(maxN, N-start)):
+                    if len(shift[0]) < dim:
+                        shift[0] = np.concatenate((shift[0],
+                                                   rand.random_sample(dim-len(shift[0]))))
+                    return lattice_points(N, dim, shift[0], start, curN)
+                batches = self.fn.SampleLvl(inds=inds, M=min(maxN, N-start),
+                                            points=points)
+                if isinstance(batches, (tuple, list)) and len(batches) == 2 \
+                   and isinstance(batches[0], np.ndarray):
+                    batches = [batches]
+                for batch, batch_time in batches:
+                    cur = np.sum(batch, axis=0)
+                    total = cur if total is None else total + cur
+                    count += batch.shape[0]
+                    total_time += batch_time
+            values.append(total / count)
+        return np.stack(values), total_time
+
+    def _reduceBatches(self, mods, batches):
+        # batches is either (values, time), as a tuple or a list, or an
+        # iterator over them
+        if isinstance(batches, (tuple, list)) and len(batches) == 2 and \
+           isinstance(batches[0], np.ndarray):
+            batches = [batches]
+        # Every batch is reduced before the next one is generated
+        moments = self.last_itr.computedMoments()
+        res = None
+        for values, samples_time in batches:
+            delta = _delta_samples(values, mods)
+            cur = (values.shape[0], _power_sums(delta, moments),
+                   _power_sums(values[:, 0], moments), samples_time,
+                   _central_sums(delta, moments),
+                   _central_sums(values[:, 0], moments))
+            res = cur if res is None else _sum_samples(res, cur)
+        if res is None:
+            raise ValueError("fnSampleLvl returned an empty iterator of batches")
+        return res
+
+    def _sampleLvls(self, jobs, offsets=None, pool=None, chunk_sizes=None):
+        # jobs is a list of (mods, inds, M), or (mods, inds, M, N) in QMC
+        # mode where N is the number of points per shift. The samples of
+        # every job are split in chunks of at most maxM samples and the sums
+        # of the chunks of a job are reduced pairwise. If a pool is given, the chunks of
+        # all jobs are distributed among its workers.
+        # When the run has a seed, every chunk is drawn from the random
+        # stream of (seed, level, index of first sample in chunk), where
+        # offsets are the number of samples drawn previously on the levels
+        # of the jobs. Likewise, chunk_sizes default to those given by the
+        # cost of previous calls, see _chunkSize.
+        update_offsets = offsets is None
+        if update_offsets:
+            offsets = [self._drawn.get(_lvl_key(job[1][0]), 0) for job in jobs]
+        if chunk_sizes is None:
+            chunk_sizes = [self._chunkSize(job) for job in jobs]
+        seed = getattr(self.params, "seed", None)
+        results = [None] * len(jobs)
+        todoM = np.array([job[2] for job in jobs], dtype=np.int)
+        calcM = np.zeros(len(jobs), dtype=np.int)
+        # In QMC mode the chunk sizes are numbers of lattice points, so every
+        # chunk has as many shifts as fit in it, and at least one
+        chunk_args = [() if len(job) < 4 else (job[3], chunk_size)
+                      for job, chunk_size in zip(jobs, chunk_sizes)]
+        chunk_shifts = [chunk_size if len(job) < 4
+                        else max(1, chunk_size // job[3])
+                        for job, chunk_size in zip(jobs, chunk_sizes)]
+        while np.any(calcM < todoM):
+            chunks = [(k, curM) for k in range(0, len(jobs))
+                      for curM in _split_samples(todoM[k]-calcM[k],
+                                                 chunk_shifts[k])]
+            args = []
+            start = offsets + calcM
+            for k, curM in chunks:
+                key = None if seed is None \
+                      else get_stream_key(seed, jobs[k][1][0], start[k])
+                args.append((jobs[k][0], jobs[k][1], curM, key) +
+                            chunk_args[k])
+                start[k] += curM
+            if pool is None:
+                out = itertools.starmap(self._sampleChunk, args)
+            else:
+                out = pool.map(_pool_sample_chunk, args, chunksize=1)
+            for k, grp in itertools.groupby(zip(chunks, out),
+                                            key=lambda x: x[0][0]):
+                res = _tree_reduce(_sum_samples, [o for _, o in grp])
+                results[k] = res if results[k] is None \
+                             else _sum_samples(results[k], res)
+                calcM[k] += res[0]
+        if update_offsets:
+            self._addDrawn(jobs, results)
+        return results
+
+    def _sampleLvlsBatched(self, lvls, jobs):
+        # Same as _sampleLvls, but every call to fnSampleLvls computes one
+        # chunk of all levels that still need samples.
+        seed = getattr(self.params, "seed", None)
+        results = [None] * len(jobs)
+        todoM = np.array([job[2] for job in jobs], dtype=np.int)
+        calcM = np.zeros(len(jobs), dtype=np.int)
+        while np.any(calcM < todoM):
+            active = np.nonzero(calcM < todoM)[0]
+            requests = [(lvls[k], jobs[k][1], jobs[k][0],
+                         np.minimum(todoM[k]-calcM[k], self._chunkSize(jobs[k])))
+                        for k in active]
+            if seed is not None:
+                self.fn.Seed(_batch_stream_key(seed, self._batch_calls))
+            self._batch_calls += 1
+            out = self.fn.SampleLvls(requests=requests)
+            for k, batches in zip(active, out):
+                res = self._reduceBatches(jobs[k][0], batches)
+                results[k] = res if results[k] is None \
+                             else _sum_samples(results[k], res)
+                calcM[k] += res[0]
+        self._addDrawn(jobs, results)
+        return results
+
+    def _addDrawn(self, jobs, results):
+        for job, res in zip(jobs, results):
+            key = _lvl_key(job[1][0])
+            self._drawn[key] = self._drawn.get(key, 0) + res[0]
+            # The samples, the delta samples and the powers of either
+            # are in memory at the same time
+            psums = res[1]
+            bytes_per_sample = (len(job[1]) + 2) * psums.dtype.itemsize * \
+                               int(np.prod(psums.shape[1:]))
+            # In QMC mode, the cost is that of a single lattice point
+            evals = res[0] * (job[3] if len(job) > 3 else 1)
+            prev_time, prev_M, _ = self._lvl_cost.get(key, (0., 0, 0))
+            self._lvl_cost[key] = (prev_time + res[3], prev_M + evals,
+                                   bytes_per_sample)
+
+    def _chunkSize(self, job):
+        # Largest number of samples, or of lattice points in QMC mode, per
+        # call to fnSampleLvl that satisfies maxM, mem_budget and
+        # chunk_time, based on the cost of previous calls for the same level
+        maxM = self.params.maxM
+        cost = self._lvl_cost.get(_lvl_key(job[1][0]))
+        if cost is None:
+            return maxM
+        total_time, total_M, bytes_per_sample = cost
+        mem_budget = getattr(self.params, "mem_budget", None)
+        if mem_budget is not None:
+            maxM = np.minimum(maxM, mem_budget // bytes_per_sample)
+        chunk_time = getattr(self.params, "chunk_time", None)
+        if chunk_time is not None and total_time > 0:
+            maxM = np.minimum(maxM, int(chunk_time * total_M / total_time))
+        return int(np.maximum(maxM, 1))
+
+    def SampleLvl(self, mods, inds, M):
+        return self._sampleLvls([(mods, inds, M)])[0]
 
     #@profile
     def _genSamples(self, totalM):
@@ -763,26 +1644,224 @@ estimate optimal number of levels"
         totalM[active] -= self.last_itr.M[active]
         if np.sum(totalM) == 0:
             return False
-        for i in range(0, lvls_count):
-            if totalM[i] <= 0:
-                continue
-            if self.params.verbose >= VERBOSE_DEBUG:
+        todo = np.nonzero(totalM > 0)[0]
+        if self.params.verbose >= VERBOSE_DEBUG:
+            for i in todo:
                 print("Doing", totalM[i], "of level", lvls[i])
-            mods, inds = expand_delta(lvls[i])
-            args = self.SampleLvl(mods, inds, totalM[i])
-            self.last_itr.addSamples(i, *args)
+        jobs = [expand_delta(lvls[i]) + (totalM[i],) for i in todo]
+        if getattr(self.params, "qmc", False):
+            jobs = [job + (self._qmcPoints(lvls[i]),)
+                    for i, job in zip(todo, jobs)]
+        pool = None if hasattr(self.fn, "SampleLvls") else self._getPool()
+        with self.profiler.span("sample"):
+            if hasattr(self.fn, "SampleLvls"):
+                results = self._sampleLvlsBatched([lvls[i] for i in todo], jobs)
+            elif pool is None:
+                results = self._sampleLvls(jobs)
+            elif getattr(self.params, "par_chunks", False):
+                results = self._sampleLvls(jobs, pool=pool)
+            else:
+                # The workers were forked with the state of an earlier
+                # iteration, so offsets and chunk sizes are computed here
+                offsets = [self._drawn.get(_lvl_key(job[1][0]), 0) for job in jobs]
+                chunk_sizes = [self._chunkSize(job) for job in jobs]
+                results = pool.map(_pool_sample_lvl,
+                                   zip(jobs, offsets, chunk_sizes), chunksize=1)
+                self._addDrawn(jobs, results)
+        self.profiler.count("samples", int(np.sum(totalM)))
+
+        with self.profiler.span("accumulate"):
+            args = [None if x[0] is None else np.stack(x) for x in zip(*results)]
+            self.last_itr.addSamples_many(todo, *args)
             if self.last_itr != self.all_itr:
-                self.all_itr.addSamples(i, *args)
+                self.all_itr.addSamples_many(todo, *args)
 
         self._estimateAll()
         return True
 
+    def _genTheorySamples(self, TOL, todoM):
+        # Generates the samples todoM from _calcTheoryM. In progressive
+        # mode, only a fraction of the missing samples is generated before
+        # the variances and theta are estimated again and todoM is
+        # recomputed. At least one such step is done, further ones only
+        # while the error is larger than TOL.
+        fraction = getattr(self.params, "progressive", 1.)
+        if fraction >= 1:
+            return self._genSamples(todoM)
+        samples_added = False
+        while True:
+            missing = np.maximum(todoM - self.last_itr.M, 0)
+            if np.sum(missing) == 0:
+                break
+            stepM = self.last_itr.M + np.ceil(fraction *
+                                              missing).astype(np.int)
+            samples_added = self._genSamples(stepM) or samples_added
+            self.Q.theta = np.maximum(self._calcTheta(TOL, self.bias),
+                                      self.params.theta)
+            todoM = self._calcTheoryM(TOL, self.Q.theta, self.Vl_estimate,
+                                      self.Wl_estimate)
+            if self.totalErrorEst() < TOL:
+                break
+        return samples_added
+
+    def _qmcPoints(self, lvl):
+        # Number of lattice points per shift of a level in QMC mode
+        return self._qmc_N.get(_lvl_key(lvl), self.params.qmc_N0)
+
+    def _refineQMC(self, TOL):
+        # Used instead of _calcTheoryM in QMC mode. The number of shifts of
+        # every level is fixed and the statistical error is reduced by
+        # doubling the number of points of the level with the largest
+        # variance per work, until the error is small enough. The
+        # variance is assumed to at least halve when the points double.
+        # The level is sampled again with the new points. Levels that have
+        # qmc_max_N points are not refined further.
+        S = self.params.qmc_shifts
+        samples_added = self._genSamples(np.maximum(self.last_itr.M, S))
+        from scipy.stats import norm
+        Ca = norm.ppf(self.params.confidence)
+        while True:
+            Vl = self.Vl_estimate / self.last_itr.M
+            if Ca * np.sqrt(np.sum(Vl)) <= self.Q.theta * TOL:
+                return samples_added
+            refinable = np.array([self._qmcPoints(self.last_itr.lvls_get(j))
+                                  < self.params.qmc_max_N
+                                  for j in range(self.last_itr.lvls_count)])
+            if not np.any(refinable):
+                warnings.warn("All levels have qmc_max_N lattice points, \
+the statistical error might be larger than required")
+                return samples_added
+            i = np.argmax(np.where(refinable,
+                                   Vl / (self.Wl_estimate * self.last_itr.M),
+                                   -np.inf))
+            lvl = self.last_itr.lvls_get(i)
+            self._qmc_N[_lvl_key(lvl)] = 2 * self._qmcPoints(lvl)
+            todoM = self.last_itr.M.copy()
+            self.last_itr.zero_samples(i)
+            if self.last_itr != self.all_itr:
+                self.all_itr.zero_samples(i)
+            samples_added = self._genSamples(todoM) or samples_added
+
+    def _getPool(self):
+        workers = getattr(self.params, "workers", 1)
+        if workers <= 1:
+            return None
+        if self._pool is None:
+            import multiprocessing
+            # Workers get the run by inheriting _pool_run, which needs fork
+            try:
+                ctx = multiprocessing.get_context("fork")
+            except ValueError:
+                raise ValueError("workers > 1 requires a platform where \
+processes can be forked")
+            global _pool_run
+            _pool_run = self
+            self._pool = ctx.Pool(workers, initializer=_pool_init)
+        return self._pool
+
+    def _closePool(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def save_checkpoint(self, path):
+        """
+        Saves the iterations, the levels and the number of samples drawn in
+        every level to the npz file path, so that load_checkpoint can
+        continue the run without recomputing any samples. Parameters and
+        functions are not saved.
+        """
+        data = dict()
+        if len(self.iters) > 0:
+            indptr, indices, values = self.last_itr._lvls.to_csr()
+            data["lvls_dim"] = np.diff(indptr).astype(setutil.ind_t)
+            data["lvls_j"] = indices
+            data["lvls_data"] = values
+        for i, itr in enumerate(self.iters):
+            data.update(_itr_to_dict(itr, "itr{}_".format(i)))
+        if not self.params.reuse_samples and len(self.iters) > 0:
+            data.update(_itr_to_dict(self._all_itr, "all_"))
+        data["iters_count"] = np.array(len(self.iters))
+        data["state"] = np.array([dict(drawn=self._drawn,
+                                       lvl_cost=self._lvl_cost,
+                                       batch_calls=self._batch_calls,
+                                       qmc_N=self._qmc_N)],
+                                 dtype=object)
+        # Write to a temporary file first, so that an interrupted write does
+        # not destroy the previous checkpoint
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **data)
+        os.rename(tmp, path)
+
+    def load_checkpoint(self, path):
+        """
+        Restores the state saved by save_checkpoint. The parameters and
+        functions of the run must be set as in the saved run. Calling
+        doRun afterwards skips the tolerances that were already done.
+        """
+        with np.load(path, allow_pickle=True) as f:
+            data = dict(f.items())
+        lvls = setutil.VarSizeList(min_dim=self.params.min_dim)
+        count = int(data["iters_count"])
+        if count > 0:
+            indptr = np.concatenate(([0], np.cumsum(data["lvls_dim"])))
+            lvls.add_from_csr(indptr, data["lvls_j"], data["lvls_data"])
+        self.iters = [_itr_from_dict(data, "itr{}_".format(i), lvls)
+                      for i in range(count)]
+        if "all_M" in data:
+            self._all_itr = _itr_from_dict(data, "all_", lvls)
+        state = data["state"][0]
+        self._drawn = state["drawn"]
+        self._lvl_cost = state["lvl_cost"]
+        self._batch_calls = state["batch_calls"]
+        self._qmc_N = state["qmc_N"]
+
+    def _workSpent(self):
+        if self.params.reuse_samples:
+            return self.last_itr.calcTotalWork()
+        return np.sum([itr.calcTotalWork() for itr in self.iters])
+
+    def _predictCost(self, TOL):
+        # Work and time of the samples that are needed to reach TOL according
+        # to the current estimates of the variances and the work of the levels
+        if getattr(self.params, "qmc", False):
+            # The number of points is refined during the iteration, so only
+            # the budget already spent is checked
+            return 0., 0.
+        theta = np.maximum(self._calcTheta(TOL, self.bias), self.params.theta)
+        M = self._calcTheoryM(TOL, theta, self.Vl_estimate, self.Wl_estimate)
+        if self.params.reuse_samples:
+            M = np.maximum(M - self.last_itr.M, 0)
+        # Levels without samples have no measured time, it is predicted from
+        # the work model scaled by the time per work of the sampled levels
+        sampled = self.last_itr.M > 0
+        Tl = self.last_itr.calcTl()
+        if np.any(sampled) and not np.all(sampled):
+            time_per_work = np.sum(self.last_itr.tT[sampled]) / \
+                            np.sum(self.last_itr.M[sampled] *
+                                   self.Wl_estimate[sampled])
+            Tl = np.where(sampled, Tl, time_per_work * self.Wl_estimate)
+        return np.sum(M * self.Wl_estimate), np.sum(M * Tl)
+
+    def _budgetExceeded(self, TOL, tStart):
+        max_time = getattr(self.params, "max_time", None)
+        max_work = getattr(self.params, "max_work", None)
+        if (max_time is None and max_work is None) or \
+           self.last_itr is None or self.last_itr.lvls_count == 0:
+            return False
+        work, t = self._predictCost(TOL)
+        return (max_work is not None and self._workSpent() + work > max_work) or \
+            (max_time is not None and time.time() - tStart + t > max_time)
+
     def _calcTheta(self, TOL, bias_est):
         if not self.params.const_theta:
             return 1 - bias_est/TOL
         return self.params.theta
 
     def _calcTheoryM(self, TOL, theta, Vl, Wl, ceil=True, minM=1):
+        from scipy.stats import norm
         Ca = norm.ppf(self.params.confidence)
         M = (theta * TOL / Ca)**-2 *\
             np.sum(np.sqrt(Wl * Vl)) * np.sqrt(Vl / Wl)
@@ -793,7 +1872,30 @@ estimate optimal number of levels"
         return M
 
     def doRun(self, finalTOL=None, TOLs=None):
+        checkpoint = getattr(self.params, "checkpoint", None)
+        if checkpoint is not None and len(self.iters) == 0 and \
+           os.path.exists(checkpoint):
+            self.load_checkpoint(checkpoint)
+        profile_json = getattr(self.params, "profile_json", None)
+        profile_trace = getattr(self.params, "profile_trace", None)
+        if not self.profiler.enabled and \
+           (getattr(self.params, "profile", False) or hasattr(self.fn, "Profile")
+            or profile_json is not None or profile_trace is not None):
+            self.profiler = profiler.Profiler(callback=getattr(self.fn,
+                                                               "Profile", None))
+        try:
+            with self.profiler.span("run"):
+                self._doRun(finalTOL=finalTOL, TOLs=TOLs)
+        finally:
+            self._closePool()
+            if profile_json is not None:
+                profiler.save_profile(profile_json, self.iters)
+            if profile_trace is not None:
+                self.profiler.save_trace(profile_trace)
+
+    def _doRun(self, finalTOL=None, TOLs=None):
         timer = Timer()
+        tStart = time.time()
 
         self._checkFunctions()
         finalTOL = finalTOL or self.params.TOL
@@ -816,10 +1918,32 @@ estimate optimal number of levels"
 
         def less(a, b, rel_tol=1e-09, abs_tol=0.0):
             return a-b <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
+
+        if self.last_itr is not None and self.last_itr.TOL is not None:
+            # Continuing a previous run, skip the tolerances that are done
+            last_TOL = self.last_itr.TOL
+            done = self.params.bayesian or self.totalErrorEst() < last_TOL
+            if done and less(last_TOL, finalTOL) and \
+               self.totalErrorEst() <= finalTOL:
+                TOLs = []
+            elif done:
+                TOLs = [TOL for TOL in TOLs if not less(last_TOL, TOL)]
+            else:
+                TOLs = [TOL for TOL in TOLs if less(TOL, last_TOL)]
+
+        checkpoint = getattr(self.params, "checkpoint", None)
+        checkpoint_interval = getattr(self.params, "checkpoint_interval", 0)
+        last_checkpoint = time.time()
+        stop = False
         for TOL in TOLs:
             print_info("TOL", TOL)
             timer.tic()
             while True:
+                if self._budgetExceeded(TOL, tStart):
+                    print_info("Stopping since the next iteration is expected \
+to exceed the time or work budget")
+                    stop = True
+                    break
                 # Skip adding an iteration if the previous one is empty
                 timer.tic()
                 if len(self.iters) == 0:
@@ -839,7 +1963,8 @@ estimate optimal number of levels"
 
                 self.last_itr.TOL = TOL
                 samples_added = False
-                gc.collect()
+                with self.profiler.span("gc"):
+                    gc.collect()
                 if self.params.bayesian and self.last_itr.lvls_count > 0:
                     L = self._estimateOptimalL(TOL)
                     if L > self.last_itr.lvls_count:
@@ -860,17 +1985,23 @@ estimate optimal number of levels"
                     self.Q.theta = np.maximum(self._calcTheta(TOL, self.bias),
                                               self.params.theta)
 
-                todoM = self._calcTheoryM(TOL, self.Q.theta,
-                                          self.Vl_estimate,
-                                          self.Wl_estimate)
-                print_debug("theta", self.Q.theta)
-                print_debug("New M: ", todoM)
-                if not self.params.reuse_samples:
-                    self.last_itr.zero_samples()
+                if getattr(self.params, "qmc", False):
+                    if not self.params.reuse_samples:
+                        self.last_itr.zero_samples()
+                    samples_added = self._refineQMC(TOL) or samples_added
+                else:
+                    todoM = self._calcTheoryM(TOL, self.Q.theta,
+                                              self.Vl_estimate,
+                                              self.Wl_estimate)
+                    print_debug("theta", self.Q.theta)
+                    print_debug("New M: ", todoM)
+                    if not self.params.reuse_samples:
+                        self.last_itr.zero_samples()
 
-                if verbose > VERBOSE_INFO:
-                    timer.ptoc()
-                samples_added = self._genSamples(todoM) or samples_added
+                    if verbose > VERBOSE_INFO:
+                        timer.ptoc()
+                    samples_added = self._genTheorySamples(TOL, todoM) or \
+                                    samples_added
                 self.last_itr.totalTime = timer.toc()
                 self.output(verbose=verbose)
                 print_info("------------------------------------------------")
@@ -878,7 +2009,14 @@ estimate optimal number of levels"
                     timer.ptoc()
                 if samples_added:
                     if self.fn.ItrDone is not None:
-                        self.fn.ItrDone()
+                        with self.profiler.span("itr_done"):
+                            self.fn.ItrDone()
+                    if checkpoint is not None and \
+                       time.time() - last_checkpoint >= checkpoint_interval:
+                        with self.profiler.span("checkpoint"):
+                            self.save_checkpoint(checkpoint)
+                        last_checkpoint = time.time()
+                    self.last_itr.profile = self.profiler.collect()
                 else:
                     # remove last iteration since it is empty
                     assert(self.params.bayesian or self.totalErrorEst() < TOL)
@@ -886,10 +2024,15 @@ estimate optimal number of levels"
                 if self.params.bayesian or self.totalErrorEst() < TOL:
                     break
 
+            if stop:
+                timer.toc()
+                break
             print_info("MIMC iteration for TOL={} took {} seconds".format(TOL, timer.toc()))
             print_info("################################################")
             if less(TOL, finalTOL) and self.totalErrorEst() <= finalTOL:
                 break
+        if checkpoint is not None:
+            self.save_checkpoint(checkpoint)
         print_info("MIMC run for TOL={} took {} seconds".format(finalTOL, timer.toc()))
 
 
@@ -897,6 +2040,42 @@ estimate optimal number of levels"
 def work_estimate(lvls, gamma):
     return np.prod(np.exp(lvls.to_dense_matrix(base=0)*gamma), axis=1)
 
+@public
+def fit_work_model(lvls, Tl, gamma=None):
+    """
+    Fits the model a + b*exp(gamma.l) to the times per sample Tl of the
+    levels in the matrix lvls. When gamma is None, it is fitted as well.
+    Returns a, b and gamma.
+
+    The relative errors are minimized, so that the constant overhead of
+    the coarse levels is fitted as well as the cost of the fine ones.
+    Levels whose time is not positive, e.g. because they are cheaper than
+    the resolution of the timer, are ignored.
+    """
+    from scipy.optimize import nnls, minimize
+    lvls = np.array(lvls, dtype=np.float)
+    Tl = np.array(Tl, dtype=np.float)
+    usable = np.isfinite(Tl) & (Tl > 0)
+    if not np.any(usable):
+        raise ValueError("At least one time must be positive")
+    lvls, Tl = lvls[usable], Tl[usable]
+
+    def fit_ab(gamma):
+        # Returns the optimal a, b for the given gamma and the residual
+        A = np.vstack((np.ones(len(Tl)), np.exp(lvls.dot(gamma)))).T
+        return nnls(A / Tl[:, None], np.ones(len(Tl)))
+
+    if gamma is None:
+        # a and b are eliminated, only gamma is fitted by a nonlinear
+        # optimization starting from the log-linear fit
+        A = np.hstack((np.ones((len(Tl), 1)), lvls))
+        gamma = np.linalg.lstsq(A, np.log(Tl), rcond=-1)[0][1:]
+        if len(Tl) > 2:
+            gamma = minimize(lambda g: fit_ab(g)[1], gamma,
+                             method='Nelder-Mead').x
+    (a, b), _ = fit_ab(gamma)
+    return a, b, gamma
+
 def expand_delta(lvl):
     """
     This routine takes a multi-index level and produces
@@ -962,12 +2141,12 @@ def calcMIMCRate(w, s, gamma):
         log_rate = d-1 + 2*(dz-1)*(1+zeta)
     return rate, log_rate
 
-def extend_prof_lvls(lvls, profCalc, min_lvls):
+def extend_prof_lvls(lvls, profCalc, min_lvls, incremental=False):
     added = 0
     if len(lvls) == 0:
         # add seed
         lvls.add_from_list([[]])
         added += 1
     while added < 1 or (len(lvls) < min_lvls):
-        lvls.expand_set(profCalc)
+        lvls.expand_set(profCalc, incremental=incremental)
         added += 1
@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import json
+
+__all__ = []
+
+def public(sym):
+    __all__.append(sym.__name__)
+    return sym
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_null_span = _NullSpan()
+
+
+@public
+class NullProfiler(object):
+    """
+    Profiler that records nothing, used when profiling is disabled.
+    """
+    enabled = False
+
+    def span(self, name):
+        return _null_span
+
+    def count(self, name, value=1):
+        pass
+
+    def collect(self):
+        return None
+
+
+class _Span(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        self.profiler._depth += 1
+        return self
+
+    def __exit__(self, *args):
+        self.profiler._depth -= 1
+        self.profiler._spanEnded(self.name, self.start,
+                                 time.time() - self.start)
+        return False
+
+
+@public
+class Profiler(object):
+    """
+    Records the wall time spent in named spans and the values of named
+    counters. The totals since the last call to collect are returned by
+    collect, all spans are kept to be saved as a Chrome trace.
+
+    callback(event) is called with a dictionary for every span that ends,
+    with keys type="span", name, start and duration, and for every counter
+    increment, with keys type="counter", name, time and value.
+    """
+    enabled = True
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.events = []       # (name, start, duration, depth) of all spans
+        self.counter_events = []   # (name, time, total) of all counters
+        self._spans = dict()       # name -> [count, time] since collect
+        self._counters = dict()    # name -> value since collect
+        self._totals = dict()      # name -> value since creation
+        self._depth = 0
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def _spanEnded(self, name, start, duration):
+        self.events.append((name, start, duration, self._depth))
+        s = self._spans.setdefault(name, [0, 0.])
+        s[0] += 1
+        s[1] += duration
+        if self.callback is not None:
+            self.callback(dict(type="span", name=name, start=start,
+                               duration=duration))
+
+    def count(self, name, value=1):
+        t = time.time()
+        self._counters[name] = self._counters.get(name, 0) + value
+        self._totals[name] = self._totals.get(name, 0) + value
+        self.counter_events.append((name, t, self._totals[name]))
+        if self.callback is not None:
+            self.callback(dict(type="counter", name=name, time=t,
+                               value=value))
+
+    def collect(self):
+        """
+        Returns a dictionary with the number of calls and the total time of
+        every span and the value of every counter since the last call.
+        """
+        ret = dict(spans=dict((k, dict(count=v[0], time=v[1]))
+                              for k, v in self._spans.items()),
+                   counters=dict(self._counters))
+        self._spans = dict()
+        self._counters = dict()
+        return ret
+
+    def save_trace(self, path):
+        """
+        Saves all spans and counters in the Chrome trace event format, which
+        can be opened with chrome://tracing or Perfetto.
+        """
+        pid = os.getpid()
+        events = [dict(name=name, ph="X", ts=start*1e6, dur=duration*1e6,
+                       pid=pid, tid=0, args=dict(depth=depth))
+                  for name, start, duration, depth in self.events]
+        events += [dict(name=name, ph="C", ts=t*1e6, pid=pid, tid=0,
+                        args={name: value})
+                   for name, t, value in self.counter_events]
+        with open(path, "w") as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms"), f)
+
+
+@public
+def save_profile(path, iters):
+    """
+    Saves the profiles that were collected in the iterations iters, which
+    are MIMCItrData objects, as a JSON list.
+    """
+    data = [dict(TOL=itr.TOL, totalTime=itr.totalTime, **itr.profile)
+            for itr in iters if getattr(itr, "profile", None) is not None]
+    with open(path, "w") as f:
+        json.dump(data, f, indent=1)
@@ -84,6 +84,8 @@ __lib__.FreeIndexSet.argtypes = [ct.c_voidp]
 __lib__.GetIndexSet.restype = ct.c_voidp
 __lib__.GetIndexSet.argtypes = [ct.c_voidp, ct.c_voidp, ct.c_double,
                                 ct.POINTER(ct.POINTER(ct.c_double))]
+__lib__.ExpandIndexSet.restype = None
+__lib__.ExpandIndexSet.argtypes = [ct.c_voidp, ct.c_voidp, ct.c_double]
 __lib__.GenTDSet.restype = None
 __lib__.GenTDSet.argtypes = [__ct_ind_t__, __ct_ind_t__,
                              __arr_ind_t__, ct.c_uint32]
@@ -146,6 +148,18 @@ __lib__.VarSizeList_from_matrix.argtypes = [ct.c_voidp,
                                             __arr_ind_t__, ct.c_uint32,
                                             __arr_ind_t__, ct.c_uint32]
 
+__lib__.VarSizeList_to_csr.restype = None
+__lib__.VarSizeList_to_csr.argtypes = [ct.c_voidp, ct.c_uint32, ct.c_uint32,
+                                       __arr_uint32__, ct.c_uint32,
+                                       __arr_ind_t__, __arr_ind_t__,
+                                       ct.c_uint32]
+
+__lib__.VarSizeList_from_csr.restype = ct.c_voidp
+__lib__.VarSizeList_from_csr.argtypes = [ct.c_voidp,
+                                         __arr_uint32__, ct.c_uint32,
+                                         __arr_ind_t__, __arr_ind_t__,
+                                         ct.c_uint32]
+
 __lib__.VarSizeList_find.restype = ct.c_int32
 __lib__.VarSizeList_find.argtypes = [ct.c_voidp, __arr_ind_t__,
                                      __arr_ind_t__, __ct_ind_t__]
@@ -252,26 +266,81 @@ class VarSizeList(object):
     def dense_itr(self, start=0, end=None):
         if end is None:
             end = len(self)
+        if start >= end:
+            return
+        indptr, indices, data = self.to_csr(start, end)
         dims = self.get_dim()
-        active_dims = self.get_active_dim()
+        base = __lib__.GetDefaultSetBase()
         for i in xrange(start, end):
             item = np.empty(np.maximum(self.min_dim, dims[i]), dtype=ind_t)
-            data = np.empty(active_dims[i], dtype=ind_t)
-            j    = np.empty(active_dims[i], dtype=ind_t)
-            __lib__.VarSizeList_get(self._handle, i, data, j, len(data))
-            item.fill(__lib__.GetDefaultSetBase())
-            item[j] = data
+            item.fill(base)
+            k = slice(indptr[i-start], indptr[i-start+1])
+            item[indices[k]] = data[k]
             yield item
 
     def sparse_itr(self, start=0, end=None):
         if end is None:
             end = len(self)
-        dims = self.get_active_dim()
-        for i in xrange(start, end):
-            data = np.empty(dims[i], dtype=ind_t)
-            j    = np.empty(dims[i], dtype=ind_t)
-            __lib__.VarSizeList_get(self._handle, i, data, j, len(data))
-            yield j, data
+        if start >= end:
+            return
+        indptr, indices, data = self.to_csr(start, end)
+        for i in xrange(end-start):
+            k = slice(indptr[i], indptr[i+1])
+            yield indices[k], data[k]
+
+    def to_csr(self, start=0, end=None):
+        """
+        Returns the indices start to end-1 in the compressed sparse row
+        format, as the arrays indptr, indices and data. The non-base entries
+        of index start+i are in the dimensions indices[indptr[i]:indptr[i+1]]
+        and have the values data[indptr[i]:indptr[i+1]].
+        """
+        if end is None:
+            end = len(self)
+        assert(0 <= start <= end <= len(self))
+        nnz = int(np.sum(self.get_active_dim()[start:end]))
+        indptr = np.empty(end-start+1, dtype=np.uint32)
+        indices = np.empty(nnz, dtype=ind_t)
+        data = np.empty(nnz, dtype=ind_t)
+        __lib__.VarSizeList_to_csr(self._handle, start, end, indptr,
+                                   len(indptr), indices, data, nnz)
+        return indptr, indices, data
+
+    def add_from_csr(self, indptr, indices, data):
+        """
+        Adds the indices given in the compressed sparse row format, see
+        to_csr. The column indices of a row need not be sorted, but must
+        be distinct.
+        """
+        indptr = np.array(indptr, dtype=np.uint32)
+        indices = np.array(indices, dtype=ind_t)
+        data = np.array(data, dtype=ind_t)
+        assert(len(indices) == len(data))
+        sizes = np.diff(indptr.astype(np.int64))
+        if len(indptr) == 0 or np.any(sizes < 0) or indptr[-1] > len(data):
+            raise ValueError("indptr must be non-decreasing and at most the \
+number of entries")
+        # The library expects the entries of every row sorted by dimension
+        start, end = indptr[0], indptr[-1]
+        rows = np.repeat(np.arange(len(sizes)), sizes)
+        order = np.lexsort((indices[start:end], rows))
+        indices[start:end] = indices[start:end][order]
+        data[start:end] = data[start:end][order]
+        if np.any((np.diff(indices[start:end].astype(np.int64)) == 0) &
+                  (np.diff(rows) == 0)):
+            raise ValueError("The column indices of a row must be distinct")
+        __lib__.VarSizeList_from_csr(self._handle, indptr, len(indptr)-1,
+                                     indices, data, len(data))
+
+    @staticmethod
+    def from_csr(indptr, indices, data, min_dim=0):
+        """
+        Returns a new VarSizeList with the indices given in the compressed
+        sparse row format, see to_csr.
+        """
+        ret = VarSizeList(min_dim=min_dim)
+        ret.add_from_csr(indptr, indices, data)
+        return ret
 
     def __len__(self):
         return __lib__.VarSizeList_count(self._handle)
@@ -287,22 +356,25 @@ class VarSizeList(object):
 
     def to_sparse_matrix(self, d_start=0, d_end=None):
         # Assumes that the martix is base 0
-        d_end = d_end or self.max_dim()
+        d_end = d_end or np.maximum(self.min_dim, self.max_dim())
         assert(d_end >= d_start)
-        ind_count = np.sum(self.get_active_dim())
-        ij = np.empty(int(ind_count*2), dtype=ind_t)
-        data = np.empty(ind_count, dtype=ind_t)
-        __lib__.VarSizeList_to_matrix(self._handle, ij, len(ij), data,
-                                      len(data))
+        indptr, indices, data = self.to_csr()
         from scipy.sparse import csr_matrix
-        mat = csr_matrix((data-__lib__.GetDefaultSetBase(), (ij[::2], ij[1::2])),
+        mat = csr_matrix((data-__lib__.GetDefaultSetBase(), indices, indptr),
                          shape=(len(self),
                                 np.maximum(self.min_dim,
                                            np.maximum(d_end, self.max_dim()))))
         return mat[:, d_start:d_end]
 
     def to_dense_matrix(self, d_start=0, d_end=None, base=0):
-        return np.array(self.to_sparse_matrix(d_start, d_end).todense()+base)
+        d_end = d_end or np.maximum(self.min_dim, self.max_dim())
+        assert(d_end >= d_start)
+        indptr, indices, data = self.to_csr()
+        mat = np.zeros((len(self), np.maximum(d_end, self.max_dim())),
+                       dtype=ind_t)
+        rows = np.repeat(np.arange(len(self)), np.diff(indptr))
+        mat[rows, indices] = data-__lib__.GetDefaultSetBase()
+        return mat[:, d_start:d_end] + base
 
     def get_dim(self, i=None):
         if i is None:
@@ -425,10 +497,20 @@ class VarSizeList(object):
     def is_boundary(self):
         return self.count_neighbors() < self.max_dim()
 
-    def expand_set(self, profCalc, max_prof=None):
+    def expand_set(self, profCalc, max_prof=None, incremental=False):
+        # Adds all indices with profit <= max_prof, which defaults to the
+        # minimum profit of the outer indices. If incremental, only indices
+        # that are reachable from the outer indices of the set are checked,
+        # instead of building the whole set again, which assumes that the
+        # set is downward closed and that profits increase with the indices.
         if max_prof is None:
             max_prof = self.get_min_outer_prof(profCalc)
-        __lib__.GetIndexSet(self._handle, profCalc._handle, np.float(max_prof), None)
+        if incremental:
+            __lib__.ExpandIndexSet(self._handle, profCalc._handle,
+                                   np.float(max_prof))
+        else:
+            __lib__.GetIndexSet(self._handle, profCalc._handle,
+                                np.float(max_prof), None)
 
     def get_min_outer_prof(self, profCalc):
         return __lib__.GetMinOuterProfit(self._handle, profCalc._handle)
@@ -34,7 +34,8 @@ def parse_known_args(parser, return_unknown=False):
 def RunStandardTest(fnSampleLvl=None,
                     fnAddExtraArgs=None,
                     fnInit=None,
-                    fnSeed=np.random.seed, profCalc=None):
+                    fnSeed=np.random.seed, profCalc=None,
+                    fnSampleLvls=None):
     import warnings
     import os.path
     import mimclib.mimc as mimc
@@ -66,8 +67,13 @@ def RunStandardTest(fnSampleLvl=None,
         fnAddExtraArgs(parser)
     mimc.MIMCRun.addOptionsToParser(parser)
     mimcRun = mimc.MIMCRun(**vars(parse_known_args(parser)))
-    fnSampleLvl = lambda inds, M, fn=fnSampleLvl: fn(mimcRun, inds, M)
-    mimcRun.setFunctions(fnSampleLvl=fnSampleLvl)
+    if fnSampleLvl is not None:
+        fnSampleLvl = lambda inds, M, fn=fnSampleLvl, **kwargs: \
+                      fn(mimcRun, inds, M, **kwargs)
+        mimcRun.setFunctions(fnSampleLvl=fnSampleLvl)
+    if fnSampleLvls is not None:
+        fnSampleLvls = lambda requests, fn=fnSampleLvls: fn(mimcRun, requests)
+        mimcRun.setFunctions(fnSampleLvls=fnSampleLvls)
 
     import time
     tStart = time.time()
@@ -76,6 +82,10 @@ def RunStandardTest(fnSampleLvl=None,
 
     if mimcRun.params.qoi_seed >= 0 and fnSeed is not None:
         fnSeed(mimcRun.params.qoi_seed)
+        # The samples of every level are drawn from random streams derived
+        # from qoi_seed, independently of the number of workers.
+        mimcRun.params.seed = mimcRun.params.qoi_seed
+        mimcRun.setFunctions(fnSeed=fnSeed)
 
     fnItrDone = None
 
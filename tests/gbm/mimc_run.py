@@ -94,7 +94,7 @@ class CustomClass(mimclib.mimc.custom_obj):
     def __float__(self):
         return self.data
 
-def mySampleQoI(run, inds, M):
+def mySampleQoI(run, inds, M, points=None):
     meshes = (run.params.qoi_T/run.fn.Hierarchy(inds)).reshape(-1).astype(np.int)
     maxN = np.max(meshes)
 
@@ -106,7 +106,12 @@ def mySampleQoI(run, inds, M):
     elif run.params.qoi_type == "arr":
         solves = np.empty((M, len(inds), 2), dtype=float)
 
-    dW = np.random.normal(size=(M, maxN))/np.sqrt(maxN)
+    if points is None:
+        dW = np.random.normal(size=(M, maxN))/np.sqrt(maxN)
+    else:
+        # QMC mode, -mimc_qmc True
+        from scipy.stats import norm
+        dW = norm.ppf(points(maxN))/np.sqrt(maxN)
     for i, mesh in enumerate(meshes):
         assert(maxN % mesh == 0)
         dWl = np.sum(dW.reshape((M, -1, maxN//mesh)), axis=2)